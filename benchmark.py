@@ -0,0 +1,368 @@
+# benchmark.py
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from aiohttp import web
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import Config
+from db import get_db_connection, payment_cache
+from db_async import run_db
+from migrations import apply_migrations
+from bot import create_dispatcher, close_services
+from qr import start_qr_pool
+from servers import get_registry, reset_registry
+from provisioning import job_runner
+import check_clients
+
+# Пользователи бенчмарка берутся из отдельного диапазона chat_id и удаляются после прогона
+BENCH_USER_BASE = 9_000_000_000
+BENCH_ADMIN_ID = BENCH_USER_BASE - 1
+BENCH_TOKEN = "123456:BENCHMARK-TOKEN"
+BENCH_REGION = 'Finland'
+
+class FakeWgEasy:
+    def __init__(self, latency=0.0, clients=0):
+        self.latency = latency
+        self.clients = {}
+        self.sessions = set()
+        self.requests = Counter()
+        self._addresses = itertools.count(2)
+        for i in range(clients):
+            self._add_client(f"seed-{i}")
+
+    def _add_client(self, name):
+        client_id = str(uuid.uuid4())
+        n = next(self._addresses)
+        now = datetime.now().isoformat()
+        self.clients[client_id] = {
+            'id': client_id,
+            'name': name,
+            'enabled': True,
+            'address': f"10.8.{(n >> 8) & 255}.{n & 255}",
+            'publicKey': client_id,
+            'createdAt': now,
+            'updatedAt': now,
+            'persistentKeepalive': 'off',
+            'latestHandshakeAt': None,
+            'transferRx': 0,
+            'transferTx': 0,
+        }
+        return client_id
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        resource = request.match_info.route.resource
+        self.requests[f"{request.method} {resource.canonical if resource else request.path}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.path != '/api/session' and request.cookies.get('connect.sid') not in self.sessions:
+            return web.json_response({'error': 'Not Logged In'}, status=401)
+        return await handler(request)
+
+    async def create_session(self, request):
+        token = uuid.uuid4().hex
+        self.sessions.add(token)
+        response = web.json_response({'success': True})
+        response.set_cookie('connect.sid', token)
+        return response
+
+    async def list_clients(self, request):
+        return web.json_response(list(self.clients.values()))
+
+    async def create_client(self, request):
+        body = await request.json()
+        self._add_client(body['name'])
+        return web.json_response({'success': True})
+
+    def _get_client(self, request):
+        client = self.clients.get(request.match_info['client_id'])
+        if client is None:
+            raise web.HTTPNotFound()
+        return client
+
+    async def delete_client(self, request):
+        self._get_client(request)
+        del self.clients[request.match_info['client_id']]
+        return web.json_response({'success': True})
+
+    async def enable_client(self, request):
+        self._get_client(request)['enabled'] = True
+        return web.json_response({'success': True})
+
+    async def disable_client(self, request):
+        self._get_client(request)['enabled'] = False
+        return web.json_response({'success': True})
+
+    async def client_configuration(self, request):
+        client = self._get_client(request)
+        return web.Response(text=(
+            "[Interface]\n"
+            f"PrivateKey = {client['publicKey']}\n"
+            f"Address = {client['address']}/24\n"
+            "DNS = 1.1.1.1\n\n"
+            "[Peer]\n"
+            "PublicKey = benchmark\n"
+            "AllowedIPs = 0.0.0.0/0, ::/0\n"
+            "Endpoint = 127.0.0.1:51820\n"
+        ))
+
+    def create_app(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_post('/api/session', self.create_session)
+        app.router.add_get('/api/wireguard/client', self.list_clients)
+        app.router.add_post('/api/wireguard/client', self.create_client)
+        app.router.add_delete('/api/wireguard/client/{client_id}', self.delete_client)
+        app.router.add_post('/api/wireguard/client/{client_id}/enable', self.enable_client)
+        app.router.add_post('/api/wireguard/client/{client_id}/disable', self.disable_client)
+        app.router.add_get('/api/wireguard/client/{client_id}/configuration', self.client_configuration)
+        return app
+
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id, method, data):
+        message_id = next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f"photo-{message_id}", 'file_unique_id': f"photo-{message_id}", 'width': 256, 'height': 256}]
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f"document-{message_id}", 'file_unique_id': f"document-{message_id}"}
+        elif method == 'sendMessage':
+            message['text'] = data.get('text', '')
+        if 'caption' in data:
+            message['caption'] = data['caption']
+        return message
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageCaption'):
+            result = self._message(int(data.get('chat_id', 0)), method, data)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+async def start_app(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+class Benchmark:
+    def __init__(self, bot, dp):
+        self.bot = bot
+        self.dp = dp
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, **payload):
+        return types.Update.model_validate({'update_id': next(self._update_ids), **payload}, context={'bot': self.bot})
+
+    def _message(self, chat_id, **fields):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            **fields
+        }
+
+    async def _timed(self, step, update):
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[step] += 1
+            logging.getLogger(__name__).error(f"Ошибка на шаге {step}: {e}")
+        self.samples[step].append(time.perf_counter() - started)
+
+    async def user_flow(self, chat_id, server_button):
+        await self._timed('start', self._update(message=self._message(chat_id, text='/start')))
+        await self._timed('buy_server', self._update(message=self._message(chat_id, text=server_button)))
+        photo = [{'file_id': f"receipt-{chat_id}", 'file_unique_id': f"receipt-{chat_id}", 'width': 256, 'height': 256}]
+        await self._timed('handle_file_upload', self._update(message=self._message(chat_id, photo=photo)))
+
+        admin_message = self._message(BENCH_ADMIN_ID, photo=photo, caption=f"Чек от пользователя {chat_id} на сервер {BENCH_REGION}")
+        callback = {
+            'id': str(next(self._update_ids)),
+            'from': {'id': BENCH_ADMIN_ID, 'is_bot': False, 'first_name': 'Admin'},
+            'chat_instance': 'benchmark',
+            'data': f"approve_{chat_id}_{BENCH_REGION}",
+            'message': admin_message,
+        }
+        await self._timed('handle_approval', self._update(callback_query=callback))
+
+    async def run_flows(self, users, concurrency):
+        limit = asyncio.Semaphore(concurrency)
+
+        server_button = get_registry().get_region(BENCH_REGION).button_text
+
+        async def limited(i):
+            async with limit:
+                await self.user_flow(BENCH_USER_BASE + i, server_button)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(users)))
+        return time.perf_counter() - started
+
+def backdate_bench_clients(users):
+    # Половина подписок попадает в окно предупреждения, половина — в окно удаления
+    with get_db_connection() as connection:
+        with connection.cursor() as cursor:
+            middle = BENCH_USER_BASE + users // 2
+            cursor.execute(
+                "UPDATE clients SET date_payed = NOW() - INTERVAL 31 DAY WHERE user_id >= %s AND user_id < %s",
+                (BENCH_USER_BASE, middle)
+            )
+            cursor.execute(
+                "UPDATE clients SET date_payed = NOW() - INTERVAL 34 DAY WHERE user_id >= %s AND user_id < %s",
+                (middle, BENCH_USER_BASE + users)
+            )
+        connection.commit()
+    payment_cache.clear()
+
+def cleanup_bench_users(users):
+    with get_db_connection() as connection:
+        with connection.cursor() as cursor:
+            # Удаляются только ID, которые использует прогон: администратор и пользователи BENCH_USER_BASE..+users
+            for table, column in (('clients', 'user_id'), ('user_states', 'user_id'), ('users', 'chat_id')):
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE {column} BETWEEN %s AND %s",
+                    (BENCH_ADMIN_ID, BENCH_USER_BASE + users - 1)
+                )
+            # Ключи задач строятся из chat_id администратора и пользователей, поэтому повторный прогон начинает с пустой очереди
+            # Префиксы заканчиваются двоеточием после полного ID, поэтому задачи других пользователей не совпадают
+            prefixes = [f"approve:{BENCH_ADMIN_ID}:%"] + [
+                f"{kind}:{BENCH_USER_BASE + i}:%"
+                for kind in ('disable', 'remove', 'notify')
+                for i in range(users)
+            ]
+            cursor.executemany("DELETE FROM jobs WHERE job_key LIKE %s", [(prefix,) for prefix in prefixes])
+        connection.commit()
+    payment_cache.clear()
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+def print_report(samples, errors, wall_time, users, provision_time, expiry_time):
+    print(f"\nПользовательских сценариев: {users} за {wall_time:.2f} с ({users / wall_time:.1f} сценариев/с)")
+    print(f"{'шаг':<22}{'кол-во':>8}{'оп/с':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'ошибок':>8}")
+    for step, values in samples.items():
+        ordered = sorted(values)
+        print(
+            f"{step:<22}{len(ordered):>8}{len(ordered) / wall_time:>10.1f}"
+            f"{percentile(ordered, 50) * 1000:>10.1f}{percentile(ordered, 95) * 1000:>10.1f}"
+            f"{percentile(ordered, 99) * 1000:>10.1f}{errors[step]:>8}"
+        )
+    print(f"Завершение очереди подключений после последнего одобрения: {provision_time:.2f} с")
+    print(f"check_clients.main: {expiry_time:.2f} с")
+
+async def main(args):
+    logging.getLogger().setLevel(args.log_level)
+
+    # Узлы засеяны неравномерно, чтобы новые клиенты распределялись по наименее загруженным
+    wg_servers = [
+        FakeWgEasy(latency=args.wg_latency / 1000, clients=args.wg_clients * (i + 1))
+        for i in range(args.nodes)
+    ]
+    telegram = FakeTelegram(latency=args.tg_latency / 1000)
+    wg_apps = [await start_app(wg_server.create_app(), 0) for wg_server in wg_servers]
+    tg_runner, tg_url = await start_app(telegram.create_app(), 0)
+
+    Config.TELEGRAM_ID = str(BENCH_ADMIN_ID)
+    Config.WG_SERVERS = json.dumps([{
+        'region': BENCH_REGION,
+        'title': 'Финляндия',
+        'nodes': [{'name': f"bench-{i}", 'url': url} for i, (_, url) in enumerate(wg_apps)]
+    }])
+    reset_registry()
+
+    if not await run_db(apply_migrations):
+        print("Не удалось применить миграции базы данных", file=sys.stderr)
+        return 1
+    await run_db(cleanup_bench_users, args.users)
+    await start_qr_pool()
+
+    bot = Bot(token=BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(tg_url)))
+    dp = create_dispatcher()
+    job_runner.start(bot=bot, fsm_storage=dp.fsm.storage)
+    benchmark = Benchmark(bot, dp)
+
+    try:
+        wall_time = await benchmark.run_flows(args.users, args.concurrency)
+        # Одобрение только ставит задачу в очередь; ждём, пока обработчики создадут всех клиентов
+        started = time.perf_counter()
+        await job_runner.drain()
+        await job_runner.close()
+        provision_time = time.perf_counter() - started
+        await dp.fsm.storage.flush()
+
+        await run_db(backdate_bench_clients, args.users)
+        started = time.perf_counter()
+        await check_clients.main(bot)
+        expiry_time = time.perf_counter() - started
+
+        print_report(benchmark.samples, benchmark.errors, wall_time, args.users, provision_time, expiry_time)
+        for i, wg_server in enumerate(wg_servers):
+            print(f"Запросы к wg-easy bench-{i}: {dict(wg_server.requests)}")
+        print(f"Вызовы Telegram Bot API: {dict(telegram.calls)}")
+    finally:
+        await dp.fsm.storage.close()
+        await run_db(cleanup_bench_users, args.users)
+        await bot.session.close()
+        await close_services()
+        for wg_runner, _ in wg_apps:
+            await wg_runner.cleanup()
+        await tg_runner.cleanup()
+
+    if sum(benchmark.errors.values()):
+        return 1
+    if args.max_p95 is not None:
+        slow = [step for step, values in benchmark.samples.items() if percentile(sorted(values), 95) * 1000 > args.max_p95]
+        if slow:
+            print(f"p95 превышает {args.max_p95} мс на шагах: {', '.join(slow)}", file=sys.stderr)
+            return 1
+    return 0
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк бота с локальными заменами wg-easy и Telegram Bot API")
+    parser.add_argument('--users', type=int, default=200, help="количество пользовательских сценариев")
+    parser.add_argument('--concurrency', type=int, default=50, help="одновременно выполняемых сценариев")
+    parser.add_argument('--nodes', type=int, default=2, help="фиктивных узлов wg-easy в регионе")
+    parser.add_argument('--wg-clients', type=int, default=1000, help="клиентов на первом фиктивном узле wg-easy до начала прогона; на i-м узле в i раз больше")
+    parser.add_argument('--wg-latency', type=float, default=20, help="задержка ответа wg-easy, мс")
+    parser.add_argument('--tg-latency', type=float, default=30, help="задержка ответа Telegram Bot API, мс")
+    parser.add_argument('--max-p95', type=float, default=None, help="завершиться с ошибкой, если p95 любого шага выше, мс")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args(sys.argv[1:]))))
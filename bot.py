@@ -1,17 +1,64 @@
 import asyncio
+import signal
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F, types
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.storage.base import StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from buy import start, buy_server, cancel, handle_file_upload, show_contacts
-from db import get_user_state, get_all_users_from_db
+from db import get_db_pool, get_lock_pool, close_db_pool, payment_cache
+from db_async import run_db, shutdown_db_executor
+from migrations import apply_migrations
+from storage import MySQLStorage
+from middlewares import ConcurrencyLimitMiddleware, ThrottleMiddleware, CallbackDedupMiddleware, UnitOfWorkMiddleware
 from payments import handle_approval
+from wg import close_wg_apis, snapshot_stats
+from notifier import notifier
+from provisioning import job_runner
+from expiry import expiry_scheduler
+from qr import start_qr_pool, shutdown_qr_pool
+from media import stats as media_stats
+from metrics import (
+    HandlerMetricsMiddleware, FSM_CACHED, FSM_DIRTY, NOTIFICATIONS_PENDING, JOBS_RUNNING, EXPIRY_SUBSCRIPTIONS, DB_POOL_IN_USE,
+    CACHE_ENTRIES, CACHE_LOOKUPS, CACHE_INVALIDATIONS, NOTIFICATIONS_SENT,
+    start_metrics_server, stop_metrics_server
+)
 from config import Config
 from states import BuyProcess
 from logger import logger
 
-async def main():
-    bot = Bot(token=Config.TELEGRAM_BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+def cache_stats():
+    return {'payment': payment_cache.stats(), 'file_id': media_stats()}
+
+def create_dispatcher():
+    storage = MySQLStorage()
+    dp = Dispatcher(storage=storage)
+
+    # Частота обновлений от пользователя проверяется раньше общего ограничения, чтобы флуд не занимал его слоты
+    dp.update.outer_middleware(ThrottleMiddleware())
+    # Одно ограничение на все обновления: и при long polling, и в режиме webhook
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware())
+    dp.callback_query.outer_middleware(CallbackDedupMiddleware())
+
+    # Время выполнения измеряется для каждого зарегистрированного обработчика сообщений и callback-запросов
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    # Одно соединение с базой данных на обработчик вместо отдельного на каждый вызов db.py
+    dp.message.middleware(UnitOfWorkMiddleware())
+    dp.callback_query.middleware(UnitOfWorkMiddleware())
+
+    FSM_CACHED.set_function(lambda: storage.stats()['cached'])
+    FSM_DIRTY.set_function(lambda: storage.stats()['dirty'])
+    NOTIFICATIONS_PENDING.set_function(lambda: notifier.stats()['queued'])
+    JOBS_RUNNING.set_function(lambda: job_runner.running)
+    EXPIRY_SUBSCRIPTIONS.set_function(lambda: expiry_scheduler.stats()['subscriptions'])
+    DB_POOL_IN_USE.set_function(lambda: get_db_pool().stats()['in_use'])
+    CACHE_ENTRIES.set_function(lambda: {name: stats['size'] for name, stats in cache_stats().items()})
+    CACHE_LOOKUPS.set_function(lambda: {
+        (name, result): stats[field]
+        for name, stats in cache_stats().items()
+        for result, field in (('hit', 'hits'), ('miss', 'misses'))
+    })
+    CACHE_INVALIDATIONS.set_function(lambda: {name: stats['invalidations'] for name, stats in cache_stats().items()})
+    NOTIFICATIONS_SENT.set_function(lambda: dict(notifier.outcomes))
 
     dp.message.register(start, F.text == "/start")
     dp.message.register(buy_server, F.text.startswith("Купить "), BuyProcess.Start)
@@ -21,16 +68,97 @@ async def main():
 
     dp.callback_query.register(handle_approval, F.data.startswith('approve_') | F.data.startswith('reject_'))
 
-    users = get_all_users_from_db()
-    for user in users:
-        user_id = user['chat_id']
-        saved_state = get_user_state(user_id)
-        if saved_state:
-            key = StorageKey(user_id=user_id, chat_id=user_id, bot_id=bot.id)
-            await dp.fsm.storage.set_state(key=key, state=saved_state)
-            logger.info(f"Состояние для пользователя {user_id} восстановлено: {saved_state}")
+    return dp
+
+async def close_services():
+    logger.info(f"Статистика пула соединений с базой данных: {get_db_pool().stats()}")
+    logger.info(f"Статистика пула соединений блокировок: {get_lock_pool().stats()}")
+    logger.info(f"Статистика кэша оплат: {payment_cache.stats()}")
+    logger.info(f"Статистика кэша file_id: {media_stats()}")
+    logger.info(f"Списки клиентов wg-easy в памяти: {snapshot_stats()}")
+    await stop_metrics_server()
+    # Задачи подключения ещё отправляют сообщения, поэтому очередь уведомлений закрывается после них
+    await expiry_scheduler.close()
+    await job_runner.close()
+    await notifier.close()
+    await close_wg_apis()
+    shutdown_qr_pool()
+    shutdown_db_executor()
+    close_db_pool()
 
+async def run_polling(bot, dp):
+    # Telegram не отдаёт обновления через getUpdates, пока установлен webhook
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+async def run_webhook(bot, dp):
+    app = web.Application()
+    # Обновление обрабатывается до ответа Telegram, поэтому max_connections вебхука ограничивает поток входящих запросов
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=False, secret_token=Config.WEBHOOK_SECRET
+    ).register(app, path=Config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, Config.WEBHOOK_HOST, Config.WEBHOOK_PORT).start()
+    logger.info(f"Webhook-сервер запущен на {Config.WEBHOOK_HOST}:{Config.WEBHOOK_PORT}{Config.WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # На Windows обработчики сигналов недоступны, остановка только через KeyboardInterrupt
+            pass
+
+    try:
+        await bot.set_webhook(
+            f"{Config.WEBHOOK_URL}{Config.WEBHOOK_PATH}",
+            secret_token=Config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=Config.WEBHOOK_MAX_CONNECTIONS
+        )
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+async def main():
+    if Config.BOT_MODE not in ('polling', 'webhook'):
+        logger.error(f"Неизвестный режим работы бота: {Config.BOT_MODE}")
+        return
+    if Config.BOT_MODE == 'webhook' and not (Config.WEBHOOK_URL and Config.WEBHOOK_SECRET):
+        logger.error("Для режима webhook необходимо задать WEBHOOK_URL и WEBHOOK_SECRET")
+        return
+    if Config.MULTI_REPLICA and Config.BOT_MODE != 'webhook':
+        # getUpdates отдаёт обновления только одному процессу; реплики принимают их через общий балансировщик webhook
+        logger.error("Несколько реплик бота поддерживаются только в режиме webhook")
+        return
+
+    if not await run_db(apply_migrations):
+        logger.error("Не удалось применить миграции базы данных, запуск бота отменён")
+        shutdown_db_executor()
+        close_db_pool()
+        return
+
+    await start_qr_pool()
+    await start_metrics_server()
+
+    bot = Bot(token=Config.TELEGRAM_BOT_TOKEN)
+    dp = create_dispatcher()
+    # Задачи, прерванные прошлым запуском, подхватываются по истечении аренды
+    job_runner.start(bot=bot, fsm_storage=dp.fsm.storage)
+
+    try:
+        await expiry_scheduler.start()
+        if Config.BOT_MODE == 'webhook':
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+    finally:
+        await close_services()
+
 if __name__ == '__main__':
     asyncio.run(main())
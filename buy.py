@@ -3,22 +3,21 @@ from aiogram import types
 from aiogram.fsm.context import FSMContext
 from config import Config
 from states import BuyProcess
-from db import add_user, set_user_state, user_already_has_subscription, update_user_payment, get_user_state
+from db_async import add_user, user_already_has_subscription, commit_unit_of_work
 from keyboards import get_main_menu_keyboard, get_cancel_keyboard
-from utils import safe_send_message, safe_send_photo
+from servers import get_registry
+from utils import safe_send_message
+from media import load_asset, send_cached_photo
 from logger import logger
 import os
-from aiogram.types import FSInputFile
 
 async def start(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     logger.info(f"Command 'start' used by user with chat_id: {chat_id}")
 
-    saved_state = get_user_state(chat_id)
-    if saved_state:
-        await state.set_state(saved_state)
-
-    add_user(chat_id)
+    await add_user(chat_id)
+    # Соединение возвращается в пул до отправки сообщений, а не после всего обработчика
+    await commit_unit_of_work()
 
     keyboard = get_main_menu_keyboard()
 
@@ -29,23 +28,20 @@ async def start(message: types.Message, state: FSMContext):
         reply_markup=keyboard
     )
     await state.set_state(BuyProcess.Start)
-    set_user_state(chat_id, BuyProcess.Start)
 
 async def buy_server(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
     text = message.text
 
-    if text == "Купить 'Финляндия'":
-        server = 'Finland'
-        server_ip = Config.WG1_SERVER_IP
-    elif text == "Купить 'США'":
-        server = 'USA'
-        server_ip = Config.WG2_SERVER_IP
-    else:
+    region = get_registry().region_by_button(text)
+    if region is None:
         await safe_send_message(message.bot, chat_id, "Неизвестная команда.")
         return
+    server = region.name
 
-    if user_already_has_subscription(chat_id, server):
+    has_subscription = await user_already_has_subscription(chat_id, server)
+    await commit_unit_of_work()
+    if has_subscription:
         await safe_send_message(message.bot, chat_id, f"У вас уже есть активная подписка на сервер {server}.")
         return
 
@@ -61,13 +57,15 @@ async def buy_server(message: types.Message, state: FSMContext):
     logger.info(f"Пользователь {chat_id} выбрал сервер {server} и получил инструкции по донату.")
 
     qr_code_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DonationAlertsQrCode.png')
+    qr_code_png = load_asset(qr_code_path)
 
-    if os.path.exists(qr_code_path):
-        qr_code_input = FSInputFile(qr_code_path)
-        await safe_send_photo(
+    if qr_code_png is not None:
+        # Картинка загружается в Telegram один раз, остальным пользователям отправляется по file_id
+        await send_cached_photo(
             message.bot,
             chat_id,
-            qr_code_input,
+            qr_code_png,
+            'DonationAlertsQrCode.png',
             caption="Или используйте QR-код для доната через DonationAlerts."
         )
         logger.info(f"QR-код DonationAlerts отправлен пользователю {chat_id}.")
@@ -80,9 +78,8 @@ async def buy_server(message: types.Message, state: FSMContext):
         )
 
     await state.set_state(BuyProcess.Buying)
-    set_user_state(chat_id, BuyProcess.Buying)
-    # Сохраняем выбранный сервер в FSMContext
-    await state.update_data(server=server, server_ip=server_ip)
+    # Сохраняем выбранный сервер в FSMContext; узел внутри региона выбирается при одобрении платежа
+    await state.update_data(server=server)
     logger.info(f"Пользователь {chat_id} выбрал сервер {server}")
 
 async def cancel(message: types.Message, state: FSMContext):
@@ -98,7 +95,6 @@ async def cancel(message: types.Message, state: FSMContext):
         reply_markup=keyboard
     )
     await state.set_state(BuyProcess.Start)
-    set_user_state(chat_id, BuyProcess.Start)
 
 async def handle_file_upload(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
@@ -106,7 +102,6 @@ async def handle_file_upload(message: types.Message, state: FSMContext):
 
     data = await state.get_data()
     server = data.get('server')
-    server_ip = data.get('server_ip')
 
     from keyboards import get_approval_inline_keyboard
     inline_reply_markup = get_approval_inline_keyboard(chat_id, server)
@@ -135,7 +130,6 @@ async def handle_file_upload(message: types.Message, state: FSMContext):
     logger.info(f"Пользователь с chat_id {chat_id} отправил чек для сервера {server}.")
 
     await state.set_state(BuyProcess.WaitingPaymentConfirmation)
-    set_user_state(chat_id, BuyProcess.WaitingPaymentConfirmation)
 
 async def show_contacts(message: types.Message, state: FSMContext):
     chat_id = message.chat.id
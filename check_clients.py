@@ -1,105 +1,119 @@
+import asyncio
 import logging
-import os
-from datetime import datetime
+import time
 from db import (
     get_db_connection,
+    close_db_pool,
     get_clients_to_warn,
     get_clients_to_remove,
-    remove_client_from_db
+    purge_jobs
 )
-from wg import WgEasyAPI
+from db_async import run_db, shutdown_db_executor
+from locks import AdvisoryLock, MAINTENANCE_LOCK
+from wg import close_wg_apis
+from servers import get_registry
+from provisioning import job_runner
+from expiry import enqueue_expiry
 from config import Config
 from aiogram import Bot
-from utils import safe_send_message
+from notifier import notifier
 from logger import logger
 
-def remove_qr_code(chat_id, server):
-    qr_code_path = os.path.join('qrcodes', f'wg_qrcode_{chat_id}_{server}.png')
-    if os.path.exists(qr_code_path):
-        try:
-            os.remove(qr_code_path)
-            logger.info(f"Файл QR-кода {qr_code_path} успешно удалён")
-        except Exception as e:
-            logger.error(f"Ошибка при удалении QR-кода {qr_code_path}: {e}")
-    else:
-        logger.warning(f"Файл QR-кода {qr_code_path} не найден для удаления")
-
-async def send_warning_message(bot, chat_id, days_passed, server):
-    if days_passed == 31:
-        message_text = f"Ваша подписка на сервер {server} закончится через 2 дня. Оплатите подписку, чтобы избежать отключения."
-    elif days_passed == 32:
-        message_text = f"Ваша подписка на сервер {server} закончится завтра. Оплатите подписку, чтобы избежать отключения."
-    elif days_passed == 33:
-        message_text = f"Ваша подписка на сервер {server} закончится сегодня. Оплатите подписку, чтобы избежать отключения."
-    else:
-        message_text = f"Ваша подписка на сервер {server} скоро закончится. Пожалуйста, оплатите её."
-
-    await safe_send_message(bot, chat_id, message_text)
-
-async def main():
-    bot = Bot(token=Config.TELEGRAM_BOT_TOKEN)
-    servers = {
-        'Finland': Config.WG1_SERVER_IP,
-        'USA': Config.WG2_SERVER_IP
-    }
-
-    wg_apis = {}
-
-    for server, server_ip in servers.items():
-        wg_api = WgEasyAPI(base_url=server_ip, password=Config.WG_PASSWORD)
-        if not wg_api.authenticate():
-            logger.error(f"Не удалось аутентифицироваться в WireGuard API для сервера {server}")
-            continue
-        wg_apis[server] = wg_api
-
+def load_expiring_clients(server):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось подключиться к базе данных")
-            return
-
-        try:
-            for server, wg_api in wg_apis.items():
-                clients_to_warn = get_clients_to_warn(connection, days=30, buffer_days=3, server=server)
-                logger.info(f"Найдено {len(clients_to_warn)} клиентов для предупреждения на сервере {server}")
-
-                for client in clients_to_warn:
-                    user_id = client['user_id']
-                    chat_id = user_id
-                    date_payed = client['date_payed']
-                    days_passed = (datetime.now() - date_payed).days
-
-                    logger.info(f"Предупреждение клиента {user_id} на сервере {server}, прошло {days_passed} дней")
-
-                    if wg_api.disable_client(user_id):
-                        logger.info(f"Клиент {user_id} на сервере {server} отключён")
-                    else:
-                        logger.error(f"Не удалось отключить клиента {user_id} на сервере {server}")
-                    await send_warning_message(bot, chat_id, days_passed, server)
+            return None
 
-                clients_to_remove = get_clients_to_remove(connection, days=33, server=server)
-                logger.info(f"Найдено {len(clients_to_remove)} клиентов для удаления на сервере {server}")
+        clients_to_warn = get_clients_to_warn(connection, days=30, buffer_days=3, server=server)
+        clients_to_remove = get_clients_to_remove(connection, days=33, server=server)
+        return clients_to_warn, clients_to_remove
 
-                for user_id in clients_to_remove:
-                    chat_id = user_id
-                    logger.info(f"Удаление клиента {user_id} на сервере {server}")
-
-                    if wg_api.remove_client(user_id):
-                        logger.info(f"Клиент {user_id} на сервере {server} удалён через API")
-                        remove_qr_code(chat_id, server)
-                    else:
-                        logger.error(f"Не удалось удалить клиента {user_id} на сервере {server} через API")
-
-                    message_text = f"Подписка на сервер {server} закончилась и Вы не успели её оплатить, конфигурация была удалена."
-                    await safe_send_message(bot, chat_id, message_text)
-
-                    remove_client_from_db(connection, user_id, server)
+def schedule_expired(server, clients_to_warn, clients_to_remove):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return None
+        return enqueue_expiry(connection, server, clients_to_warn, clients_to_remove)
 
-        finally:
-            logger.info("Завершение работы check_clients.py")
-            await bot.close()
+def purge_old_jobs():
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return 0
+        return purge_jobs(connection, Config.JOB_RETENTION_DAYS)
+
+async def process_server(region):
+    server = region.name
+    report = {
+        'server': server,
+        'warn': 0,
+        'remove': 0,
+        'jobs': 0,
+        'deleted_rows': 0,
+        'duration': 0.0,
+        'error': None
+    }
+    started = time.perf_counter()
+
+    expiring = await run_db(load_expiring_clients, server)
+    if expiring is None:
+        report['error'] = 'db'
+        return report
+    clients_to_warn, clients_to_remove = expiring
+    report['warn'], report['remove'] = len(clients_to_warn), len(clients_to_remove)
+    logger.info(f"Найдено {len(clients_to_warn)} клиентов для предупреждения на сервере {server}")
+    logger.info(f"Найдено {len(clients_to_remove)} клиентов для удаления на сервере {server}")
+
+    # Обычно эти задачи уже поставил планировщик бота; ключи совпадают, поэтому повторно создаются только пропущенные
+    scheduled = await run_db(schedule_expired, server, clients_to_warn, clients_to_remove)
+    if scheduled is None:
+        report['error'] = 'db'
+        return report
+    report['jobs'], report['deleted_rows'] = scheduled
+
+    report['duration'] = time.perf_counter() - started
+    return report
+
+async def main(bot=None):
+    bot = bot or Bot(token=Config.TELEGRAM_BOT_TOKEN)
+    started = time.perf_counter()
+
+    try:
+        # Запуски на разных хостах (cron на нескольких репликах) не должны обрабатывать одних и тех же клиентов одновременно
+        async with AdvisoryLock(MAINTENANCE_LOCK) as acquired:
+            if not acquired:
+                logger.warning("Проверка клиентов уже выполняется в другом процессе, запуск пропущен")
+                return
+            reports = await asyncio.gather(*(
+                process_server(region)
+                for region in get_registry().regions.values()
+            ))
+
+            for report in reports:
+                if report['error']:
+                    logger.error(f"Сервер {report['server']} пропущен: ошибка {report['error']}")
+                    continue
+                logger.info(
+                    f"Сервер {report['server']}: к предупреждению {report['warn']}, к удалению {report['remove']}, "
+                    f"новых задач {report['jobs']}, удалено записей из базы {report['deleted_rows']}, за {report['duration']:.2f} с"
+                )
+
+            # Задачи выполняются здесь же, включая оставшиеся с прошлых запусков; неудачные повторятся позже
+            await job_runner.drain(kinds=('disable', 'remove', 'notify'), limit=Config.CHECK_WG_CONCURRENCY, bot=bot)
+            logger.info(f"Задачи wg-easy: {job_runner.stats()}")
+            purged = await run_db(purge_old_jobs)
+            logger.info(f"Удалено выполненных задач старше {Config.JOB_RETENTION_DAYS} дней: {purged}")
+            logger.info(f"Проверка клиентов завершена за {time.perf_counter() - started:.2f} с")
+    finally:
+        logger.info("Завершение работы check_clients.py")
+        await notifier.close()
+        await bot.session.close()
+        await close_wg_apis()
+        shutdown_db_executor()
+        close_db_pool()
 
 if __name__ == '__main__':
-    import asyncio
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     logger = logging.getLogger(__name__)
     asyncio.run(main())
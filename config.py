@@ -11,6 +11,70 @@ class Config:
     DB_NAME = os.getenv('DB_NAME')
     DB_USER = os.getenv('DB_USER')
     DB_PASSWORD = os.getenv('DB_PASSWORD')
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '3600'))
+    DB_POOL_PING_INTERVAL = int(os.getenv('DB_POOL_PING_INTERVAL', '30'))
+    # Отдельный пул для блокировок GET_LOCK: по соединению на задачу под блокировкой (JOB_WORKERS или CHECK_WG_CONCURRENCY)
+    # и на блокировки обслуживания и планировщика окончания подписок
+    DB_LOCK_POOL_SIZE = int(os.getenv('DB_LOCK_POOL_SIZE', '16'))
+    # Несколько процессов бота за балансировщиком webhook: состояние FSM читается из базы при каждом обращении,
+    # кэш оплат по умолчанию выключен, потому что оплату мог записать другой процесс
+    MULTI_REPLICA = os.getenv('MULTI_REPLICA', '0') == '1'
+    PAYMENT_CACHE_TTL = int(os.getenv('PAYMENT_CACHE_TTL', '0' if MULTI_REPLICA else '300'))
+    PAYMENT_CACHE_SIZE = int(os.getenv('PAYMENT_CACHE_SIZE', '10000'))
+    FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+    FSM_FLUSH_BATCH_SIZE = int(os.getenv('FSM_FLUSH_BATCH_SIZE', '500'))
+    FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
     WG_PASSWORD = os.getenv('WG_PASSWORD')
     WG1_SERVER_IP = os.getenv('WG1_SERVER_IP')
     WG2_SERVER_IP = os.getenv('WG2_SERVER_IP')
+    # JSON-список регионов: [{"region": "Finland", "title": "Финляндия", "nodes": [{"name": "fi-1", "url": "http://..."}]}]
+    WG_SERVERS = os.getenv('WG_SERVERS')
+    # Сколько секунд список клиентов узла wg-easy используется без повторного запроса
+    WG_SNAPSHOT_TTL = float(os.getenv('WG_SNAPSHOT_TTL', '30'))
+    WG_NODE_COUNT_TTL = float(os.getenv('WG_NODE_COUNT_TTL', '60'))
+    CHECK_WG_CONCURRENCY = int(os.getenv('CHECK_WG_CONCURRENCY', '10'))
+    NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '25'))
+    NOTIFY_PER_CHAT_RATE = float(os.getenv('NOTIFY_PER_CHAT_RATE', '1'))
+    NOTIFY_PER_CHAT_BURST = int(os.getenv('NOTIFY_PER_CHAT_BURST', '3'))
+    NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '8'))
+    NOTIFY_MAX_RETRIES = int(os.getenv('NOTIFY_MAX_RETRIES', '3'))
+    NOTIFY_CHAT_BUCKETS_LIMIT = int(os.getenv('NOTIFY_CHAT_BUCKETS_LIMIT', '10000'))
+    QR_WORKERS = int(os.getenv('QR_WORKERS', '2'))
+    MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', '1000'))
+    MEDIA_CACHE_TTL = int(os.getenv('MEDIA_CACHE_TTL', '86400'))
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+    JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '300'))
+    JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))
+    JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '8'))
+    JOB_RETRY_BASE = float(os.getenv('JOB_RETRY_BASE', '5'))
+    JOB_RETRY_MAX = float(os.getenv('JOB_RETRY_MAX', '600'))
+    EXPIRY_LEADER_CHECK = float(os.getenv('EXPIRY_LEADER_CHECK', '30'))
+    EXPIRY_RELOAD_INTERVAL = float(os.getenv('EXPIRY_RELOAD_INTERVAL', '900'))
+    JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+    WG_CONNECT_TIMEOUT = float(os.getenv('WG_CONNECT_TIMEOUT', '5'))
+    WG_READ_TIMEOUT = float(os.getenv('WG_READ_TIMEOUT', '15'))
+    WG_POOL_LIMIT = int(os.getenv('WG_POOL_LIMIT', '20'))
+    WG_KEEPALIVE_TIMEOUT = float(os.getenv('WG_KEEPALIVE_TIMEOUT', '60'))
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    # text — строки как раньше, json — по одному JSON-объекту на запись
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))
+    LOG_SAMPLE_INTERVAL = float(os.getenv('LOG_SAMPLE_INTERVAL', '60'))
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    # 0 — эндпоинт метрик выключен
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '100'))
+    THROTTLE_RATE = int(os.getenv('THROTTLE_RATE', '20'))
+    THROTTLE_WINDOW = float(os.getenv('THROTTLE_WINDOW', '10'))
+    THROTTLE_USERS_LIMIT = int(os.getenv('THROTTLE_USERS_LIMIT', '10000'))
+    CALLBACK_DEDUP_COOLDOWN = float(os.getenv('CALLBACK_DEDUP_COOLDOWN', '3'))
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
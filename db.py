@@ -1,36 +1,205 @@
 # db.py
+import contextvars
+import json
 import logging
+import threading
+import uuid
 from datetime import datetime, timedelta
-import mysql.connector
 from mysql.connector import Error
 from contextlib import contextmanager
 from config import Config
-from states import BuyProcess
+from db_pool import ConnectionPool
+from cache import TTLCache, MISSING
+from metrics import observe_db, db_error
 
 logger = logging.getLogger(__name__)
 
+# Дата последней оплаты по ключу (chat_id, server); из неё же выводится статус подписки
+payment_cache = TTLCache(maxsize=Config.PAYMENT_CACHE_SIZE, ttl=Config.PAYMENT_CACHE_TTL)
+
+# Обработчики изменений оплат (планировщик окончания подписок); вызываются из потоков исполнителя базы данных
+_payment_listeners = []
+
+_pool = None
+_lock_pool = None
+_pool_lock = threading.Lock()
+
+def _create_pool(size):
+    return ConnectionPool(
+        size=size,
+        timeout=Config.DB_POOL_TIMEOUT,
+        recycle=Config.DB_POOL_RECYCLE,
+        ping_interval=Config.DB_POOL_PING_INTERVAL,
+        host=Config.DB_HOST,
+        port=Config.DB_PORT,
+        database=Config.DB_NAME,
+        user=Config.DB_USER,
+        password=Config.DB_PASSWORD
+    )
+
+def get_db_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool(Config.DB_POOL_SIZE)
+    return _pool
+
+def get_lock_pool():
+    # Блокировки GET_LOCK держат соединение всё время владения, поэтому не занимают соединения запросов
+    global _lock_pool
+    if _lock_pool is None:
+        with _pool_lock:
+            if _lock_pool is None:
+                _lock_pool = _create_pool(Config.DB_LOCK_POOL_SIZE)
+    return _lock_pool
+
+def close_db_pool():
+    global _pool, _lock_pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _lock_pool is not None:
+            _lock_pool.close()
+            _lock_pool = None
+
+class _UnitConnection:
+    # Соединение единицы работы: функции db.py фиксируют свои изменения как обычно, но фиксация откладывается до конца единицы
+    def __init__(self, unit, connection):
+        self._unit = unit
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        # Откат отменяет и всё, что было записано раньше в этой единице работы, поэтому фиксировать её уже нельзя
+        self._unit.failed = True
+        self._connection.rollback()
+
+class UnitOfWork:
+    # Все функции db.py, вызванные в одном обновлении, используют одно соединение и одну транзакцию.
+    # Соединение берётся из пула при первом запросе и возвращается после commit() или rollback()
+    def __init__(self, owner):
+        self.owner = owner
+        self.failed = False
+        self.closed = False
+        # Занят ли слот соединения на стороне цикла событий (db_async)
+        self.holds_slot = False
+        self._connection = None
+        # Изменения оплат, о которых слушатели узнают только после фиксации
+        self._payment_changes = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self._connection is not None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = _UnitConnection(self, get_db_pool().acquire())
+        return self._connection
+
+    def _release(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            get_db_pool().release(connection._connection)
+
+    def commit(self):
+        with self._lock:
+            changes, self._payment_changes = self._payment_changes, []
+            failed, self.failed = self.failed, False
+            if self._connection is None:
+                return not failed
+            committed = False
+            try:
+                if failed:
+                    logger.error("Единица работы не зафиксирована: одна из операций завершилась ошибкой")
+                    self._connection._connection.rollback()
+                else:
+                    self._connection._connection.commit()
+                    committed = True
+            except Error as e:
+                logger.error(f"Ошибка при фиксации единицы работы: {e}")
+                db_error()
+            finally:
+                self._release()
+
+        for chat_id, server, removed in changes:
+            if committed:
+                _notify_payment_changed(chat_id, server, removed)
+            else:
+                payment_cache.invalidate(_payment_key(chat_id, server))
+        return committed
+
+    def rollback(self):
+        with self._lock:
+            changes, self._payment_changes = self._payment_changes, []
+            self.failed = False
+            if self._connection is not None:
+                try:
+                    self._connection._connection.rollback()
+                except Error as e:
+                    logger.error(f"Ошибка при откате единицы работы: {e}")
+                finally:
+                    self._release()
+        # Кэш мог прочитать ещё не зафиксированную оплату
+        for chat_id, server, _ in changes:
+            payment_cache.invalidate(_payment_key(chat_id, server))
+
+_unit_of_work = contextvars.ContextVar('unit_of_work', default=None)
+
+def begin_unit_of_work(owner):
+    unit = UnitOfWork(owner)
+    return unit, _unit_of_work.set(unit)
+
+def end_unit_of_work(unit, token):
+    unit.closed = True
+    _unit_of_work.reset(token)
+
+def current_unit_of_work():
+    unit = _unit_of_work.get()
+    if unit is None or unit.closed:
+        return None
+    return unit
+
+def detach_unit_of_work():
+    _unit_of_work.set(None)
+
 @contextmanager
 def get_db_connection():
-    connection = None
+    unit = current_unit_of_work()
+    if unit is not None:
+        # Вызовы одной единицы работы из разных потоков исполнителя выполняются по очереди
+        with unit._lock:
+            try:
+                connection = unit._connect()
+            except Error as e:
+                logger.error(f"Ошибка подключения к базе данных: {e}")
+                db_error()
+                connection = None
+            yield connection
+        return
+
+    pool = get_db_pool()
     try:
-        connection = mysql.connector.connect(
-            host=Config.DB_HOST,
-            port=Config.DB_PORT,
-            database=Config.DB_NAME,
-            user=Config.DB_USER,
-            password=Config.DB_PASSWORD
-        )
-        if connection.is_connected():
-            logger.info("Соединение с базой данных установлено")
-        yield connection
+        connection = pool.acquire()
     except Error as e:
         logger.error(f"Ошибка подключения к базе данных: {e}")
+        db_error()
         yield None
+        return
+
+    try:
+        yield connection
     finally:
-        if connection and connection.is_connected():
-            connection.close()
-            logger.info("Подключение к базе данных закрыто")
+        pool.release(connection)
 
+@observe_db
 def add_user(chat_id, date_start=None):
     if date_start is None:
         date_start = datetime.now()
@@ -52,7 +221,9 @@ def add_user(chat_id, date_start=None):
             logger.info(f"Пользователь с chat_id {chat_id} добавлен/обновлён")
         except Error as e:
             logger.error(f"Ошибка при добавлении пользователя: {e}")
+            db_error()
 
+@observe_db
 def user_exists(chat_id):
     with get_db_connection() as connection:
         if connection is None:
@@ -67,8 +238,10 @@ def user_exists(chat_id):
             return result > 0
         except Error as e:
             logger.error(f"Ошибка при проверке существования пользователя: {e}")
+            db_error()
             return False
 
+@observe_db
 def add_client(user_id, server):
     with get_db_connection() as connection:
         if connection is None:
@@ -80,10 +253,13 @@ def add_client(user_id, server):
             with connection.cursor() as cursor:
                 cursor.execute(query, (user_id, server))
             connection.commit()
+            _payment_changed(user_id, server)
             logger.info(f"Клиент с user_id {user_id} добавлен на сервер {server}")
         except Error as e:
             logger.error(f"Ошибка при добавлении клиента: {e}")
+            db_error()
 
+@observe_db
 def get_user_by_chat_id(chat_id):
     with get_db_connection() as connection:
         if connection is None:
@@ -98,107 +274,125 @@ def get_user_by_chat_id(chat_id):
             return user
         except Error as e:
             logger.error(f"Ошибка при получении пользователя: {e}")
+            db_error()
             return None
 
+@observe_db
 def update_user_payment(chat_id, server):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
             return
 
+        # Проверка существования пользователя выполняется той же вставкой
+        query = "INSERT INTO clients (user_id, date_payed, server) SELECT chat_id, NOW(), %s FROM users WHERE chat_id=%s"
         try:
-            query_user = "SELECT chat_id FROM users WHERE chat_id=%s"
             with connection.cursor() as cursor:
-                cursor.execute(query_user, (chat_id,))
-                user = cursor.fetchone()
-
-                if not user:
+                cursor.execute(query, (server, chat_id))
+                if cursor.rowcount == 0:
                     logger.warning(f"Пользователь с chat_id {chat_id} не найден.")
                     return
-
-                query_add_client = "INSERT INTO clients (user_id, date_payed, server) VALUES (%s, NOW(), %s)"
-                cursor.execute(query_add_client, (chat_id, server))
             connection.commit()
+            _payment_changed(chat_id, server)
             logger.info(f"Оплата для пользователя с chat_id {chat_id} на сервер {server} обновлена.")
         except Error as e:
             logger.error(f"Ошибка при обновлении платежа пользователя: {e}")
+            db_error()
+
+LOAD_USER_STATE_QUERY = "SELECT state, data FROM user_states WHERE user_id=%s"
 
-def set_user_state(chat_id, state):
+@observe_db
+def load_user_state(chat_id):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
-            return
+            return None
 
-        query_get_user_id = "SELECT chat_id FROM users WHERE chat_id=%s"
-        query_insert_state = """
-        INSERT INTO user_states (user_id, state) VALUES (%s, %s)
-        ON DUPLICATE KEY UPDATE state=%s;
-        """
+        query = LOAD_USER_STATE_QUERY
         try:
             with connection.cursor() as cursor:
-                cursor.execute(query_get_user_id, (chat_id,))
+                cursor.execute(query, (chat_id,))
                 result = cursor.fetchone()
-
-                if result:
-                    user_id = result[0]
-                    state_str = state.state
-                    cursor.execute(query_insert_state, (user_id, state_str, state_str))
-                    connection.commit()
-                    logger.info(f"Состояние пользователя {user_id} установлено как {state_str}")
-                else:
-                    logger.warning(f"Пользователь с chat_id {chat_id} не найден.")
+            if not result:
+                return None, {}
+            state, data = result
+            return state, json.loads(data) if data else {}
+        except ValueError as e:
+            # Повреждённые данные FSM не должны блокировать пользователя: он начинает с пустого состояния
+            logger.error(f"Повреждённые данные состояния пользователя {chat_id}: {e}")
+            return None, {}
         except Error as e:
-            logger.error(f"Ошибка при установке состояния пользователя: {e}")
+            logger.error(f"Ошибка при получении состояния пользователя: {e}")
+            db_error()
+            return None
 
-def get_user_state(chat_id):
+@observe_db
+def save_user_states(rows):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
-            return None
+            return False
 
-        query_get_user_id = "SELECT chat_id FROM users WHERE chat_id=%s"
-        query_get_state = "SELECT state FROM user_states WHERE user_id=%s"
+        query = """
+        INSERT INTO user_states (user_id, state, data) VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE state=VALUES(state), data=VALUES(data);
+        """
+        params = [(user_id, state, json.dumps(data, ensure_ascii=False)) for user_id, state, data in rows]
         try:
-            with connection.cursor(dictionary=True) as cursor:
-                cursor.execute(query_get_user_id, (chat_id,))
-                result = cursor.fetchone()
+            with connection.cursor() as cursor:
+                cursor.executemany(query, params)
+            connection.commit()
+            logger.info(f"Сохранены состояния {len(params)} пользователей")
+            return True
+        except Error as e:
+            logger.error(f"Ошибка при сохранении состояний пользователей: {e}")
+            db_error()
+            return False
 
-                if result:
-                    user_id = result['chat_id']
-                    cursor.execute(query_get_state, (user_id,))
-                    user_state = cursor.fetchone()
-
-                    if user_state:
-                        state_str = user_state['state']
-                        # Преобразование строки состояния обратно в объект состояния
-                        if state_str == "BuyProcess:Start":
-                            return BuyProcess.Start
-                        elif state_str == "BuyProcess:Buying":
-                            return BuyProcess.Buying
-                        elif state_str == "BuyProcess:WaitingAnswer":
-                            return BuyProcess.WaitingAnswer
-                        elif state_str == "BuyProcess:WaitingPaymentConfirmation":
-                            return BuyProcess.WaitingPaymentConfirmation
-            return None
+@observe_db
+def save_user_state(user_id, state):
+    # Запись только состояния: данные FSM, записанные другим процессом, не затираются
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return False
+
+        query = """
+        INSERT INTO user_states (user_id, state) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE state=VALUES(state);
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, (user_id, state))
+            connection.commit()
+            return True
         except Error as e:
-            logger.error(f"Ошибка при получении состояния пользователя: {e}")
-            return None
+            logger.error(f"Ошибка при сохранении состояния пользователя {user_id}: {e}")
+            db_error()
+            return False
 
-def reset_user_state(chat_id):
+@observe_db
+def save_user_data(user_id, data):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
-            return
+            return False
 
-        query = "DELETE FROM user_states WHERE user_id=%s"
+        query = """
+        INSERT INTO user_states (user_id, data) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE data=VALUES(data);
+        """
         try:
             with connection.cursor() as cursor:
-                cursor.execute(query, (chat_id,))
+                cursor.execute(query, (user_id, json.dumps(data, ensure_ascii=False)))
             connection.commit()
-            logger.info(f"Состояние пользователя {chat_id} сброшено")
+            return True
         except Error as e:
-            logger.error(f"Ошибка при сбросе состояния пользователя: {e}")
+            logger.error(f"Ошибка при сохранении данных пользователя {user_id}: {e}")
+            db_error()
+            return False
 
+@observe_db
 def get_all_users_from_db():
     with get_db_connection() as connection:
         if connection is None:
@@ -213,123 +407,630 @@ def get_all_users_from_db():
             return users
         except Error as e:
             logger.error(f"Ошибка при получении всех пользователей: {e}")
+            db_error()
             return []
 
+def _payment_key(chat_id, server):
+    return int(chat_id), server
+
+def add_payment_listener(listener):
+    _payment_listeners.append(listener)
+
+def remove_payment_listener(listener):
+    if listener in _payment_listeners:
+        _payment_listeners.remove(listener)
+
+def _payment_changed(chat_id, server, removed=False):
+    unit = current_unit_of_work()
+    if unit is not None:
+        # Слушатель перечитает оплату из другого соединения, поэтому узнаёт о ней после фиксации
+        unit._payment_changes.append((chat_id, server, removed))
+        return
+    _notify_payment_changed(chat_id, server, removed)
+
+def _notify_payment_changed(chat_id, server, removed):
+    payment_cache.invalidate(_payment_key(chat_id, server))
+    for listener in _payment_listeners:
+        try:
+            listener(int(chat_id), server, removed)
+        except Exception as e:
+            logger.error(f"Ошибка в обработчике изменения оплаты: {e}")
+
 def is_payment_recent(chat_id, server, days=30):
+    last_payment_date = get_last_payment_date(chat_id, server)
+    return last_payment_date is not None and last_payment_date >= datetime.now() - timedelta(days=days)
+
+def get_last_payment_date(chat_id, server):
+    # Метрики базы данных считают только запрос, попадание в кэш вызовом базы не является
+    key = _payment_key(chat_id, server)
+    cached = payment_cache.get(key)
+    if cached is not MISSING:
+        return cached
+
+    version = payment_cache.version
+    last_payment_date, loaded = load_last_payment_date(chat_id, server)
+    if loaded:
+        payment_cache.set(key, last_payment_date, version=version)
+    return last_payment_date
+
+LAST_PAYMENT_DATE_QUERY = """
+    SELECT date_payed FROM clients
+    WHERE user_id=%s AND server=%s
+    ORDER BY date_payed DESC
+    LIMIT 1
+"""
+
+@observe_db
+def load_last_payment_date(chat_id, server):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
-            return False
+            return None, False
 
-        query = """
-        SELECT date_payed FROM clients
-        WHERE user_id=%s AND server=%s
-        ORDER BY date_payed DESC
-        LIMIT 1;
-        """
+        query = LAST_PAYMENT_DATE_QUERY
         try:
             with connection.cursor() as cursor:
                 cursor.execute(query, (chat_id, server))
                 result = cursor.fetchone()
-                if result:
-                    last_payment_date = result[0]
-                    if last_payment_date >= datetime.now() - timedelta(days=days):
-                        return True
-            return False
+            return (result[0] if result else None), True
         except Error as e:
-            logger.error(f"Ошибка при проверке оплаты: {e}")
-            return False
+            logger.error(f"Ошибка при получении даты последней оплаты: {e}")
+            db_error()
+            return None, False
 
-def get_last_payment_date(chat_id, server):
+def user_already_has_subscription(chat_id, server):
+    return is_payment_recent(chat_id, server, days=30)
+
+WG_CLIENT_QUERY = """
+    SELECT wg_client_id, node FROM clients
+    WHERE user_id=%s AND server=%s AND wg_client_id IS NOT NULL
+    ORDER BY date_payed DESC
+    LIMIT 1
+"""
+
+@observe_db
+def get_wg_client(chat_id, server):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
             return None
 
-        query = """
-        SELECT date_payed FROM clients
-        WHERE user_id=%s AND server=%s
-        ORDER BY date_payed DESC
-        LIMIT 1;
-        """
+        query = WG_CLIENT_QUERY
         try:
             with connection.cursor() as cursor:
                 cursor.execute(query, (chat_id, server))
                 result = cursor.fetchone()
                 if result:
-                    return result[0]
+                    return result[0], result[1]
             return None
         except Error as e:
-            logger.error(f"Ошибка при получении даты последней оплаты: {e}")
+            logger.error(f"Ошибка при получении ID клиента WireGuard: {e}")
+            db_error()
             return None
 
-def user_already_has_subscription(chat_id, server):
+@observe_db
+def set_wg_client_id(chat_id, server, wg_client_id, node=None):
     with get_db_connection() as connection:
         if connection is None:
             logger.error("Не удалось установить соединение с базой данных")
-            return False
+            return
 
-        query = """
-        SELECT * FROM clients
-        WHERE user_id = %s AND server = %s
-        AND date_payed > NOW() - INTERVAL 30 DAY
-        """
+        query = "UPDATE clients SET wg_client_id=%s, node=%s WHERE user_id=%s AND server=%s"
         try:
             with connection.cursor() as cursor:
-                cursor.execute(query, (chat_id, server))
-                result = cursor.fetchone()
-                return result is not None
+                cursor.execute(query, (wg_client_id, node, chat_id, server))
+            connection.commit()
+            logger.info(f"ID клиента WireGuard {wg_client_id} (узел {node}) сохранён для пользователя {chat_id} на сервере {server}")
         except Error as e:
-            logger.error(f"Ошибка при проверке подписки: {e}")
-            return False
+            logger.error(f"Ошибка при сохранении ID клиента WireGuard: {e}")
+            db_error()
 
 # Добавленные функции для check_clients.py
 
+# Старая строка продлившего подписку пользователя остаётся в окне предупреждения, поэтому учитывается только последняя оплата
+CLIENTS_TO_WARN_QUERY = """
+    SELECT c.user_id, c.date_payed, c.wg_client_id, c.node
+    FROM clients c
+    JOIN (
+        SELECT user_id, MAX(date_payed) AS date_payed
+        FROM clients
+        WHERE server = %s
+        GROUP BY user_id
+    ) latest ON latest.user_id = c.user_id AND latest.date_payed = c.date_payed
+    WHERE c.server = %s
+      AND c.date_payed <= NOW() - INTERVAL %s DAY
+      AND c.date_payed > NOW() - INTERVAL %s DAY
+"""
+
+@observe_db
 def get_clients_to_warn(connection, days=30, buffer_days=3, server=None):
     cursor = connection.cursor(dictionary=True)
-    query = """
-    SELECT user_id, date_payed
-    FROM clients
-    WHERE date_payed <= NOW() - INTERVAL %s DAY
-      AND date_payed > NOW() - INTERVAL %s DAY
-      AND server = %s
-    """
+    query = CLIENTS_TO_WARN_QUERY
     try:
-        cursor.execute(query, (days, days + buffer_days, server))
+        cursor.execute(query, (server, server, days, days + buffer_days))
         clients = cursor.fetchall()
         return clients
     except Error as e:
         logger.error(f"Ошибка при получении клиентов для предупреждения: {e}")
+        db_error()
         return []
     finally:
         cursor.close()
 
+# Узел и ID клиента берутся из строки последней оплаты: после продления старые строки указывают на прежний узел
+CLIENTS_TO_REMOVE_QUERY = """
+    SELECT c.user_id, c.date_payed, c.wg_client_id, c.node
+    FROM clients c
+    JOIN (
+        SELECT user_id, MAX(date_payed) AS date_payed
+        FROM clients
+        WHERE server = %s
+        GROUP BY user_id
+    ) latest ON latest.user_id = c.user_id AND latest.date_payed = c.date_payed
+    WHERE c.server = %s
+      AND c.date_payed <= NOW() - INTERVAL %s DAY
+"""
+
+@observe_db
 def get_clients_to_remove(connection, days=33, server=None):
     cursor = connection.cursor(dictionary=True)
-    query = """
-    SELECT user_id
-    FROM clients
-    WHERE date_payed <= NOW() - INTERVAL %s DAY
-    AND server = %s
-    """
+    query = CLIENTS_TO_REMOVE_QUERY
     try:
-        cursor.execute(query, (days, server))
+        cursor.execute(query, (server, server, days))
         clients = cursor.fetchall()
-        return [client['user_id'] for client in clients]
+        return clients
     except Error as e:
         logger.error(f"Ошибка при получении клиентов для удаления: {e}")
+        db_error()
         return []
     finally:
         cursor.close()
 
+@observe_db
+def get_subscriptions(connection):
+    # Последняя оплата по каждой паре (пользователь, сервер) для планировщика окончания подписок
+    cursor = connection.cursor(dictionary=True)
+    query = """
+    SELECT user_id, server, MAX(date_payed) AS date_payed
+    FROM clients
+    GROUP BY user_id, server
+    """
+    try:
+        cursor.execute(query)
+        return cursor.fetchall()
+    except Error as e:
+        logger.error(f"Ошибка при получении подписок: {e}")
+        db_error()
+        return None
+    finally:
+        cursor.close()
+
+SUBSCRIPTION_QUERY = """
+    SELECT user_id, date_payed, wg_client_id, node,
+           TIMESTAMPDIFF(DAY, date_payed, NOW()) AS days_passed
+    FROM clients
+    WHERE user_id = %s AND server = %s
+    ORDER BY date_payed DESC
+    LIMIT 1
+"""
+
+@observe_db
+def get_subscription(connection, user_id, server):
+    # Число прошедших дней считает сервер базы данных, как и в запросах check_clients
+    cursor = connection.cursor(dictionary=True)
+    query = SUBSCRIPTION_QUERY
+    try:
+        cursor.execute(query, (user_id, server))
+        return cursor.fetchone()
+    except Error as e:
+        logger.error(f"Ошибка при получении подписки пользователя {user_id}: {e}")
+        db_error()
+        return None
+    finally:
+        cursor.close()
+
+@observe_db
+def get_payment_date(connection, user_id, server):
+    # Дата последней оплаты без кэша; None — оплат нет, MISSING — ошибка базы данных
+    cursor = connection.cursor()
+    query = "SELECT MAX(date_payed) FROM clients WHERE user_id = %s AND server = %s"
+    try:
+        cursor.execute(query, (user_id, server))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except Error as e:
+        logger.error(f"Ошибка при получении даты оплаты пользователя {user_id}: {e}")
+        db_error()
+        return MISSING
+    finally:
+        cursor.close()
+
+SERVER_CLIENTS_QUERY = """
+    SELECT c.user_id, c.date_payed, c.wg_client_id, c.node,
+           TIMESTAMPDIFF(DAY, c.date_payed, NOW()) AS days_passed
+    FROM clients c
+    JOIN (
+        SELECT user_id, MAX(date_payed) AS date_payed
+        FROM clients
+        WHERE server = %s
+        GROUP BY user_id
+    ) latest ON latest.user_id = c.user_id AND latest.date_payed = c.date_payed
+    WHERE c.server = %s
+"""
+
+@observe_db
+def get_server_clients(connection, server):
+    # Все подписки сервера одним запросом для сверки с wg-easy
+    cursor = connection.cursor(dictionary=True)
+    query = SERVER_CLIENTS_QUERY
+    try:
+        cursor.execute(query, (server, server))
+        return cursor.fetchall()
+    except Error as e:
+        logger.error(f"Ошибка при получении клиентов сервера {server}: {e}")
+        db_error()
+        return None
+    finally:
+        cursor.close()
+
+@observe_db
+def set_wg_client_ids(connection, server, rows):
+    # rows: список (user_id, wg_client_id, node)
+    if not rows:
+        return 0
+
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(
+            "UPDATE clients SET wg_client_id=%s, node=%s WHERE user_id=%s AND server=%s",
+            [(wg_client_id, node, user_id, server) for user_id, wg_client_id, node in rows]
+        )
+        connection.commit()
+        logger.info(f"Обновлены ID клиентов WireGuard для {len(rows)} пользователей на сервере {server}")
+        return len(rows)
+    except Error as e:
+        connection.rollback()
+        logger.error(f"Ошибка при пакетном обновлении ID клиентов WireGuard: {e}")
+        db_error()
+        return None
+    finally:
+        cursor.close()
+
+@observe_db
 def remove_client_from_db(connection, user_id, server):
     cursor = connection.cursor()
     query = "DELETE FROM clients WHERE user_id=%s AND server=%s"
     try:
         cursor.execute(query, (user_id, server))
         connection.commit()
+        _payment_changed(user_id, server, removed=True)
         logger.info(f"Клиент с user_id {user_id} на сервере {server} удалён из базы данных")
     except Error as e:
         logger.error(f"Ошибка при удалении клиента из базы данных: {e}")
+        db_error()
+    finally:
+        cursor.close()
+
+REMOVE_CLIENTS_QUERY = "DELETE FROM clients WHERE server=%s AND user_id IN ({placeholders})"
+
+@observe_db
+def remove_clients_from_db(connection, user_ids, server, chunk_size=1000):
+    if not user_ids:
+        return 0
+
+    cursor = connection.cursor()
+    removed = 0
+    try:
+        # Все удаления по серверу выполняются одной транзакцией, порциями по chunk_size
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(REMOVE_CLIENTS_QUERY.format(placeholders=placeholders), (server, *chunk))
+            removed += cursor.rowcount
+        connection.commit()
+        for user_id in user_ids:
+            _payment_changed(user_id, server, removed=True)
+        logger.info(f"Из базы данных удалено {removed} записей клиентов на сервере {server}")
+        return removed
+    except Error as e:
+        connection.rollback()
+        logger.error(f"Ошибка при пакетном удалении клиентов из базы данных: {e}")
+        db_error()
+        return 0
+    finally:
+        cursor.close()
+
+# Очередь задач wg-easy (jobs)
+
+def _insert_job(cursor, job_key, kind, payload, max_attempts):
+    # Задача с тем же ключом не создаётся повторно; окончательно упавшая задача перезапускается с нуля.
+    # Порядок присваиваний важен: MySQL вычисляет их слева направо, поэтому status меняется последним
+    cursor.execute("""
+    INSERT INTO jobs (job_key, kind, payload, status, attempts, max_attempts, run_at, created_at, updated_at)
+    VALUES (%s, %s, %s, 'pending', 0, %s, NOW(), NOW(), NOW())
+    ON DUPLICATE KEY UPDATE
+        attempts = IF(status = 'failed', 0, attempts),
+        run_at = IF(status = 'failed', NOW(), run_at),
+        updated_at = IF(status = 'failed', NOW(), updated_at),
+        status = IF(status = 'failed', 'pending', status)
+    """, (job_key, kind, json.dumps(payload, ensure_ascii=False), max_attempts or Config.JOB_MAX_ATTEMPTS))
+    # 1 — задача создана, 2 — перезапущена после окончательной ошибки, 0 — уже есть в очереди или выполнена
+    return cursor.rowcount
+
+@observe_db
+def enqueue_job(job_key, kind, payload, max_attempts=None):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return None
+
+        try:
+            with connection.cursor() as cursor:
+                result = _insert_job(cursor, job_key, kind, payload, max_attempts)
+            connection.commit()
+            return result
+        except Error as e:
+            logger.error(f"Ошибка при добавлении задачи {job_key}: {e}")
+            db_error()
+            return None
+
+@observe_db
+def enqueue_payment_job(chat_id, server, job_key, kind, payload, max_attempts=None):
+    # Оплата и задача подключения записываются одной транзакцией: оплата без задачи не может потеряться
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return None
+
+        try:
+            with connection.cursor() as cursor:
+                result = _insert_job(cursor, job_key, kind, payload, max_attempts)
+                if result == 1:
+                    cursor.execute(
+                        "INSERT INTO clients (user_id, date_payed, server) SELECT chat_id, NOW(), %s FROM users WHERE chat_id=%s",
+                        (server, chat_id)
+                    )
+                    if cursor.rowcount == 0:
+                        logger.warning(f"Пользователь с chat_id {chat_id} не найден.")
+            connection.commit()
+            if result == 1:
+                _payment_changed(chat_id, server)
+                logger.info(f"Оплата для пользователя с chat_id {chat_id} на сервер {server} обновлена.")
+            return result
+        except Error as e:
+            connection.rollback()
+            logger.error(f"Ошибка при добавлении задачи {job_key}: {e}")
+            db_error()
+            return None
+
+@observe_db
+def enqueue_jobs(connection, jobs):
+    if not jobs:
+        return 0
+
+    cursor = connection.cursor()
+    created = 0
+    try:
+        for job_key, kind, payload in jobs:
+            if _insert_job(cursor, job_key, kind, payload, None) == 1:
+                created += 1
+        connection.commit()
+        return created
+    except Error as e:
+        connection.rollback()
+        logger.error(f"Ошибка при пакетном добавлении задач: {e}")
+        db_error()
+        return None
+    finally:
+        cursor.close()
+
+# Задачи с истёкшей арендой принадлежали упавшему или перезапущенному процессу и захватываются заново
+CLAIM_JOBS_QUERY = """
+UPDATE jobs
+SET status='running', locked_by=%s, locked_until=NOW() + INTERVAL %s SECOND,
+    attempts=attempts + 1, updated_at=NOW()
+WHERE ((status='pending' AND run_at <= NOW()) OR (status='running' AND locked_until < NOW()))
+  {kind_filter}
+ORDER BY run_at
+LIMIT %s
+"""
+
+CLAIMED_JOBS_QUERY = "SELECT id, job_key, kind, payload, attempts, max_attempts FROM jobs WHERE locked_by=%s AND status='running'"
+
+@observe_db
+def claim_jobs(worker_id, limit, lease_seconds, kinds=None):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return None
+
+        # Уникальный токен захвата: по нему выбираются только что захваченные задачи и подтверждается их завершение
+        token = f"{worker_id}:{uuid.uuid4().hex}"
+        kind_filter = ""
+        params = [token, lease_seconds]
+        if kinds:
+            kind_filter = f"AND kind IN ({', '.join(['%s'] * len(kinds))})"
+            params.extend(kinds)
+        params.append(limit)
+
+        try:
+            with connection.cursor(dictionary=True) as cursor:
+                cursor.execute(CLAIM_JOBS_QUERY.format(kind_filter=kind_filter), params)
+                connection.commit()
+                if cursor.rowcount == 0:
+                    return []
+                cursor.execute(CLAIMED_JOBS_QUERY, (token,))
+                rows = cursor.fetchall()
+            for row in rows:
+                row['payload'] = json.loads(row['payload'])
+                row['token'] = token
+            return rows
+        except Error as e:
+            logger.error(f"Ошибка при захвате задач: {e}")
+            db_error()
+            return None
+
+@observe_db
+def complete_job(job_id, token):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return False
+
+        query = """
+        UPDATE jobs SET status='done', locked_by=NULL, locked_until=NULL, last_error=NULL, updated_at=NOW()
+        WHERE id=%s AND locked_by=%s
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, (job_id, token))
+                # 0 строк: аренда истекла и задачу уже захватил другой обработчик
+                completed = cursor.rowcount == 1
+            connection.commit()
+            return completed
+        except Error as e:
+            logger.error(f"Ошибка при завершении задачи {job_id}: {e}")
+            db_error()
+            return False
+
+@observe_db
+def fail_job(job_id, token, error, retry_delay=None):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return False
+
+        if retry_delay is None:
+            query = """
+            UPDATE jobs SET status='failed', locked_by=NULL, locked_until=NULL, last_error=%s, updated_at=NOW()
+            WHERE id=%s AND locked_by=%s
+            """
+            params = (error[:1000], job_id, token)
+        else:
+            query = """
+            UPDATE jobs SET status='pending', run_at=NOW() + INTERVAL %s SECOND,
+                locked_by=NULL, locked_until=NULL, last_error=%s, updated_at=NOW()
+            WHERE id=%s AND locked_by=%s
+            """
+            params = (int(retry_delay), error[:1000], job_id, token)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+            connection.commit()
+            return True
+        except Error as e:
+            logger.error(f"Ошибка при сохранении ошибки задачи {job_id}: {e}")
+            db_error()
+            return False
+
+@observe_db
+def purge_jobs(connection, days):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("DELETE FROM jobs WHERE status='done' AND updated_at < NOW() - INTERVAL %s DAY", (days,))
+        connection.commit()
+        return cursor.rowcount
+    except Error as e:
+        logger.error(f"Ошибка при удалении выполненных задач: {e}")
+        db_error()
+        return 0
+    finally:
+        cursor.close()
+
+# Кэш file_id загруженных в Telegram файлов (media_files)
+
+@observe_db
+def get_media_file_id(bot_id, content_hash):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return None
+
+        query = "SELECT file_id FROM media_files WHERE bot_id=%s AND content_hash=%s"
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, (bot_id, content_hash))
+                result = cursor.fetchone()
+            return result[0] if result else None
+        except Error as e:
+            logger.error(f"Ошибка при получении file_id файла {content_hash}: {e}")
+            db_error()
+            return None
+
+@observe_db
+def save_media_file_id(bot_id, content_hash, file_id):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return
+
+        query = """
+        INSERT INTO media_files (bot_id, content_hash, file_id, created_at) VALUES (%s, %s, %s, NOW())
+        ON DUPLICATE KEY UPDATE file_id = VALUES(file_id), created_at = VALUES(created_at)
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(query, (bot_id, content_hash, file_id))
+            connection.commit()
+        except Error as e:
+            logger.error(f"Ошибка при сохранении file_id файла {content_hash}: {e}")
+            db_error()
+
+@observe_db
+def delete_media_file_id(bot_id, content_hash):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM media_files WHERE bot_id=%s AND content_hash=%s", (bot_id, content_hash))
+            connection.commit()
+        except Error as e:
+            logger.error(f"Ошибка при удалении file_id файла {content_hash}: {e}")
+            db_error()
+
+# Именованные блокировки MySQL (GET_LOCK) принадлежат соединению: вызывающий держит его, пока владеет блокировкой
+
+@observe_db
+def acquire_lock(connection, name, timeout=0):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        (result,) = cursor.fetchone()
+        return result == 1
+    except Error as e:
+        logger.error(f"Ошибка при захвате блокировки {name}: {e}")
+        db_error()
+        return False
+    finally:
+        cursor.close()
+
+@observe_db
+def is_lock_held(connection, name):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (name,))
+        (result,) = cursor.fetchone()
+        return result == 1
+    except Error as e:
+        logger.error(f"Ошибка при проверке блокировки {name}: {e}")
+        db_error()
+        return False
+    finally:
+        cursor.close()
+
+@observe_db
+def release_lock(connection, name):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        cursor.fetchone()
+        return True
+    except Error as e:
+        logger.error(f"Ошибка при освобождении блокировки {name}: {e}")
+        db_error()
+        return False
     finally:
         cursor.close()
@@ -0,0 +1,151 @@
+# db_async.py
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import db
+from config import Config
+
+_executor = None
+_slots = None
+_unit_slots = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Потоков столько же, сколько соединений в пуле: лишние потоки всё равно ждали бы свободного соединения
+        _executor = ThreadPoolExecutor(max_workers=Config.DB_POOL_SIZE, thread_name_prefix='db')
+    return _executor
+
+def _get_slots():
+    global _slots, _unit_slots
+    if _slots is None:
+        # Соединение пула занимается на стороне цикла событий, до передачи запроса в исполнитель: иначе потоки
+        # ждали бы в pool.acquire() соединений единиц работы, чьи фиксации стоят в очереди за ними же
+        _slots = asyncio.Semaphore(Config.DB_POOL_SIZE)
+        # Единицам работы достаётся на одно соединение меньше: разовые запросы, которых они могут ждать
+        # (например, хранилище FSM), всегда получают свободное соединение
+        _unit_slots = asyncio.Semaphore(max(1, Config.DB_POOL_SIZE - 1))
+    return _slots, _unit_slots
+
+async def _hold_unit_slot(unit):
+    # Единица работы держит соединение от первого запроса до фиксации или отката
+    if unit.holds_slot:
+        return
+    slots, unit_slots = _get_slots()
+    await unit_slots.acquire()
+    try:
+        await slots.acquire()
+    except BaseException:
+        unit_slots.release()
+        raise
+    unit.holds_slot = True
+
+def release_unit_slot(unit):
+    if unit.holds_slot:
+        unit.holds_slot = False
+        slots, unit_slots = _get_slots()
+        slots.release()
+        unit_slots.release()
+
+async def _run_in_executor(func, args, kwargs, detach):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    if detach:
+        context.run(db.detach_unit_of_work)
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await loop.run_in_executor(_get_executor(), call)
+
+async def _run_detached(func, args, kwargs, detach):
+    slots, _ = _get_slots()
+    async with slots:
+        return await _run_in_executor(func, args, kwargs, detach)
+
+async def run_db(func, *args, **kwargs):
+    unit = db.current_unit_of_work()
+    if unit is not None and unit.owner is asyncio.current_task():
+        await _hold_unit_slot(unit)
+        return await _run_in_executor(func, args, kwargs, False)
+    # Задачи, запущенные из обработчика, наследуют его контекст, но не его соединение и транзакцию
+    return await _run_detached(func, args, kwargs, unit is not None)
+
+async def run_db_outside_unit(func, *args, **kwargs):
+    # Запрос на собственном соединении из пула, даже если обработчик открыл единицу работы
+    return await _run_detached(func, args, kwargs, db.current_unit_of_work() is not None)
+
+async def _finish_unit(unit, finish):
+    if not unit.holds_slot:
+        # Обработчик не обращался к базе: соединения нет, и фиксация выполняется сразу
+        return finish()
+    try:
+        return await _run_in_executor(finish, (), {}, False)
+    finally:
+        release_unit_slot(unit)
+
+async def commit_unit_of_work():
+    # Фиксирует изменения обработчика до ответа пользователю и возвращает соединение в пул;
+    # без явного вызова единица работы фиксируется после завершения обработчика
+    unit = db.current_unit_of_work()
+    if unit is None:
+        return True
+    return await _finish_unit(unit, unit.commit)
+
+async def rollback_unit_of_work():
+    unit = db.current_unit_of_work()
+    if unit is not None:
+        await _finish_unit(unit, unit.rollback)
+
+def shutdown_db_executor():
+    global _executor, _slots, _unit_slots
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    _slots = _unit_slots = None
+
+async def add_user(chat_id, date_start=None):
+    return await run_db(db.add_user, chat_id, date_start)
+
+async def user_exists(chat_id):
+    return await run_db(db.user_exists, chat_id)
+
+async def add_client(user_id, server):
+    return await run_db(db.add_client, user_id, server)
+
+async def get_user_by_chat_id(chat_id):
+    return await run_db(db.get_user_by_chat_id, chat_id)
+
+async def update_user_payment(chat_id, server):
+    return await run_db(db.update_user_payment, chat_id, server)
+
+async def get_all_users_from_db():
+    return await run_db(db.get_all_users_from_db)
+
+async def is_payment_recent(chat_id, server, days=30):
+    return await run_db(db.is_payment_recent, chat_id, server, days)
+
+async def get_last_payment_date(chat_id, server):
+    return await run_db(db.get_last_payment_date, chat_id, server)
+
+async def user_already_has_subscription(chat_id, server):
+    return await run_db(db.user_already_has_subscription, chat_id, server)
+
+async def get_wg_client(chat_id, server):
+    return await run_db(db.get_wg_client, chat_id, server)
+
+async def set_wg_client_id(chat_id, server, wg_client_id, node=None):
+    return await run_db(db.set_wg_client_id, chat_id, server, wg_client_id, node)
+
+async def enqueue_job(job_key, kind, payload, max_attempts=None):
+    return await run_db(db.enqueue_job, job_key, kind, payload, max_attempts)
+
+async def enqueue_payment_job(chat_id, server, job_key, kind, payload, max_attempts=None):
+    return await run_db(db.enqueue_payment_job, chat_id, server, job_key, kind, payload, max_attempts)
+
+async def get_media_file_id(bot_id, content_hash):
+    return await run_db(db.get_media_file_id, bot_id, content_hash)
+
+async def save_media_file_id(bot_id, content_hash, file_id):
+    return await run_db(db.save_media_file_id, bot_id, content_hash, file_id)
+
+async def delete_media_file_id(bot_id, content_hash):
+    return await run_db(db.delete_media_file_id, bot_id, content_hash)
@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+import time
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+logger = logging.getLogger(__name__)
+
+class _PooledEntry:
+    __slots__ = ('connection', 'created_at', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+class ConnectionPool:
+    def __init__(self, size, timeout, recycle, ping_interval, **connect_kwargs):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = queue.LifoQueue()
+        self._entries = {}
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Метрики ожидания и жизненного цикла соединений
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+
+    def _connect(self):
+        connection = mysql.connector.connect(**self.connect_kwargs)
+        entry = _PooledEntry(connection)
+        with self._lock:
+            self._entries[id(connection)] = entry
+            self.created += 1
+        logger.info(f"Создано новое соединение с базой данных ({len(self._entries)}/{self.size})")
+        return entry
+
+    def _discard(self, entry):
+        with self._lock:
+            self._entries.pop(id(entry.connection), None)
+        try:
+            entry.connection.close()
+        except Error:
+            pass
+
+    def _reserve_slot(self):
+        with self._lock:
+            if len(self._entries) + self._reserved < self.size:
+                self._reserved += 1
+                return True
+            return False
+
+    def _open_reserved(self):
+        try:
+            return self._connect()
+        finally:
+            with self._lock:
+                self._reserved -= 1
+
+    def _is_healthy(self, entry):
+        now = time.monotonic()
+        if now - entry.created_at > self.recycle:
+            self.recycled += 1
+            return False
+        if now - entry.last_used > self.ping_interval:
+            try:
+                entry.connection.ping(reconnect=False)
+            except Error:
+                self.broken += 1
+                return False
+        return True
+
+    def acquire(self):
+        if self._closed:
+            raise PoolError("Пул соединений закрыт")
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                if self._reserve_slot():
+                    entry = self._open_reserved()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolError(f"Истекло время ожидания свободного соединения ({self.timeout} с)")
+                    waited = True
+                    # Ждём короткими интервалами: слот может освободиться и при исключении битого соединения
+                    try:
+                        entry = self._idle.get(timeout=min(remaining, 0.5))
+                    except queue.Empty:
+                        continue
+
+            if not self._is_healthy(entry):
+                self._discard(entry)
+                continue
+            break
+
+        wait_time = time.monotonic() - started
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+        return entry.connection
+
+    def release(self, connection):
+        with self._lock:
+            entry = self._entries.get(id(connection))
+        if entry is None:
+            return
+
+        try:
+            if self._closed or not connection.is_connected():
+                raise Error("соединение недоступно")
+            # Незавершённая транзакция держит снимок данных, поэтому откатываем её перед возвратом в пул
+            if connection.in_transaction:
+                connection.rollback()
+        except Error as e:
+            logger.warning(f"Соединение исключено из пула: {e}")
+            self.broken += 1
+            self._discard(entry)
+            return
+
+        entry.last_used = time.monotonic()
+        self._idle.put(entry)
+
+    def discard(self, connection):
+        # Соединение с незавершённым состоянием сессии (например, неснятой блокировкой) не возвращается в пул
+        with self._lock:
+            entry = self._entries.get(id(connection))
+        if entry is not None:
+            self._discard(entry)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(entry)
+        logger.info("Пул соединений с базой данных закрыт")
+
+    def stats(self):
+        with self._lock:
+            in_use = len(self._entries) - self._idle.qsize()
+            return {
+                'size': self.size,
+                'open': len(self._entries),
+                'in_use': in_use,
+                'idle': self._idle.qsize(),
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'recycled': self.recycled,
+                'broken': self.broken,
+            }
@@ -0,0 +1,295 @@
+# expiry.py
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+from db import (
+    get_db_connection,
+    get_subscriptions,
+    get_subscription,
+    remove_clients_from_db,
+    enqueue_jobs,
+    add_payment_listener,
+    remove_payment_listener
+)
+from db_async import run_db
+from locks import AdvisoryLock
+from config import Config
+from provisioning import job_runner, payment_superseded, PAYMENT_DATE_FORMAT
+from utils import safe_send_message
+from notifier import PRIORITY_LOW
+
+logger = logging.getLogger(__name__)
+
+# Дни после оплаты: с 30-го клиент отключается и получает предупреждение, на 33-й удаляется
+WARN_DAYS = (30, 31, 32)
+REMOVE_DAY = 33
+STAGE_DAYS = WARN_DAYS + (REMOVE_DAY,)
+
+def expiry_message(server, days_passed):
+    if days_passed >= REMOVE_DAY:
+        return f"Подписка на сервер {server} закончилась и Вы не успели её оплатить, конфигурация была удалена."
+    if days_passed == 31:
+        return f"Ваша подписка на сервер {server} закончится через 2 дня. Оплатите подписку, чтобы избежать отключения."
+    if days_passed == 32:
+        return f"Ваша подписка на сервер {server} закончится завтра. Оплатите подписку, чтобы избежать отключения."
+    return f"Ваша подписка на сервер {server} скоро закончится. Пожалуйста, оплатите её."
+
+def expiry_jobs(client, server, days_passed):
+    # Ключи включают дату оплаты: планировщик бота и check_clients не создают одни и те же задачи дважды
+    suffix = f"{client['user_id']}:{server}:{client['date_payed']:%Y%m%d%H%M%S}"
+    payload = {
+        'user_id': client['user_id'],
+        'server': server,
+        'node': client['node'],
+        'wg_client_id': client['wg_client_id'],
+        'date_payed': client['date_payed'].strftime(PAYMENT_DATE_FORMAT)
+    }
+    stage = min(days_passed, REMOVE_DAY)
+    kind = 'remove' if stage == REMOVE_DAY else 'disable'
+    return [
+        (f"{kind}:{suffix}", kind, payload),
+        (f"notify:{suffix}:{stage}", 'notify', {
+            'user_id': client['user_id'],
+            'server': server,
+            'days_passed': stage,
+            'date_payed': payload['date_payed']
+        }),
+    ]
+
+def enqueue_expiry(connection, server, clients_to_warn, clients_to_remove):
+    now = datetime.now()
+    jobs = [
+        job
+        for client in clients_to_warn
+        for job in expiry_jobs(client, server, client.get('days_passed', (now - client['date_payed']).days))
+    ]
+    jobs += [job for client in clients_to_remove for job in expiry_jobs(client, server, REMOVE_DAY)]
+    created = enqueue_jobs(connection, jobs)
+    if created is None:
+        return None
+
+    # Записи удаляются только после того, как задачи удаления сохранены: иначе клиент остался бы в wg-easy без записи в базе
+    user_ids = [client['user_id'] for client in clients_to_remove]
+    deleted_rows = remove_clients_from_db(connection, user_ids, server)
+    return created, deleted_rows
+
+def expire_subscription(user_id, server):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return None
+
+        client = get_subscription(connection, user_id, server)
+        if client is None:
+            return None
+        days_passed = client['days_passed']
+        if days_passed >= REMOVE_DAY:
+            scheduled = enqueue_expiry(connection, server, [], [client])
+        elif days_passed >= WARN_DAYS[0]:
+            scheduled = enqueue_expiry(connection, server, [client], [])
+        else:
+            return days_passed, 0
+        if scheduled is None:
+            return None
+        return days_passed, scheduled[0]
+
+async def notify_client_job(job, context):
+    payload = job.payload
+    if await payment_superseded(payload):
+        logger.info(f"Уведомление пользователя {payload['user_id']} о сервере {payload['server']} отменено: подписка оплачена заново")
+        return
+    await safe_send_message(context['bot'], payload['user_id'],
+                            expiry_message(payload['server'], payload['days_passed']), priority=PRIORITY_LOW)
+
+job_runner.register('notify', notify_client_job)
+
+class ExpiryScheduler:
+    def __init__(self):
+        # Куча (срок, порядковый номер, user_id, server, дата оплаты, день); записи по устаревшей дате оплаты пропускаются при извлечении
+        self._heap = []
+        self._subscriptions = {}
+        self._seq = itertools.count()
+        self._loop = None
+        self._changed = None
+        self._task = None
+        self._refreshing = set()
+        # Срабатывания выполняет только один процесс из всех запущенных — владелец блокировки
+        self._leader_lock = AdvisoryLock('expiry_scheduler')
+        self.leader = False
+        self.fired = 0
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        add_payment_listener(self.payment_changed)
+        self._task = asyncio.create_task(self._run())
+
+    async def _reload(self):
+        # Оплаты, записанные другими процессами, сюда не сообщаются; их подхватывает периодическая перезагрузка
+        rows = await run_db(self._load)
+        if rows is None:
+            return
+        current = {(row['user_id'], row['server']): row['date_payed'] for row in rows}
+        for user_id, server in self._subscriptions.keys() - current.keys():
+            self._set(user_id, server, None)
+        for (user_id, server), date_payed in current.items():
+            self._set(user_id, server, date_payed)
+
+    @staticmethod
+    def _load():
+        with get_db_connection() as connection:
+            if connection is None:
+                logger.error("Не удалось подключиться к базе данных")
+                return None
+            return get_subscriptions(connection)
+
+    def payment_changed(self, user_id, server, removed):
+        # Вызывается из потока исполнителя базы данных сразу после записи оплаты или удаления клиента
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._on_payment_changed, user_id, server, removed)
+
+    def _on_payment_changed(self, user_id, server, removed):
+        if not self.leader:
+            return
+        if removed:
+            self._set(user_id, server, None)
+            return
+        task = asyncio.create_task(self._refresh(user_id, server))
+        self._refreshing.add(task)
+        task.add_done_callback(self._refreshing.discard)
+
+    async def _refresh(self, user_id, server):
+        client = await run_db(self._fetch, user_id, server)
+        if self.leader:
+            self._set(user_id, server, client['date_payed'] if client else None)
+
+    @staticmethod
+    def _fetch(user_id, server):
+        with get_db_connection() as connection:
+            if connection is None:
+                logger.error("Не удалось подключиться к базе данных")
+                return None
+            return get_subscription(connection, user_id, server)
+
+    def _set(self, user_id, server, date_payed):
+        key = (user_id, server)
+        if date_payed is None:
+            self._subscriptions.pop(key, None)
+            return
+        if self._subscriptions.get(key) == date_payed:
+            return
+        self._subscriptions[key] = date_payed
+
+        now = datetime.now()
+        missed = [day for day in STAGE_DAYS if date_payed + timedelta(days=day) <= now]
+        # Этапы, пропущенные пока бот был остановлен, выполняются сразу, но только последний из них
+        if missed:
+            self._push(now, user_id, server, date_payed, missed[-1])
+        for day in STAGE_DAYS[len(missed):]:
+            self._push(date_payed + timedelta(days=day), user_id, server, date_payed, day)
+
+        if len(self._heap) > 2 * len(STAGE_DAYS) * len(self._subscriptions) + 1000:
+            self._compact()
+
+    def _push(self, due, user_id, server, date_payed, day):
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (due, seq, user_id, server, date_payed, day))
+        # Новый ближайший срок: цикл должен пересчитать время ожидания
+        if self._heap[0][1] == seq and self._changed is not None:
+            self._changed.set()
+
+    def _compact(self):
+        # Продления и удаления оставляют в куче устаревшие записи; периодически они вычищаются
+        self._heap = [entry for entry in self._heap if self._subscriptions.get((entry[2], entry[3])) == entry[4]]
+        heapq.heapify(self._heap)
+
+    async def _fire(self, user_id, server, date_payed, day):
+        result = await run_db(expire_subscription, user_id, server)
+        if result is None:
+            # Запись удалена другим процессом или база недоступна; пропущенное доделает check_clients
+            self._set(user_id, server, None)
+            return
+        days_passed, created = result
+        if days_passed < day:
+            client = await run_db(self._fetch, user_id, server)
+            if client is not None and client['date_payed'] != date_payed:
+                # Подписку продлили в другом процессе, а перезагрузка ещё не дошла
+                self._set(user_id, server, client['date_payed'])
+                return
+            # Часы бота и базы данных расходятся: срок по базе ещё не наступил, проверяем позже
+            self._push(datetime.now() + timedelta(minutes=1), user_id, server, date_payed, day)
+            return
+        self.fired += 1
+        if created:
+            logger.info(f"Подписка пользователя {user_id} на сервер {server}: день {days_passed}, создано задач {created}")
+            job_runner.wake()
+
+    async def _run(self):
+        while True:
+            if not await self._leader_lock.acquire():
+                await asyncio.sleep(Config.EXPIRY_LEADER_CHECK)
+                continue
+            try:
+                await self._lead()
+            finally:
+                self.leader = False
+                self._subscriptions.clear()
+                self._heap = []
+                await self._leader_lock.release()
+
+    async def _lead(self):
+        self.leader = True
+        await self._reload()
+        logger.info(f"Планировщик окончания подписок запущен в этом процессе: подписок {len(self._subscriptions)}")
+        check_at = time.monotonic() + Config.EXPIRY_LEADER_CHECK
+        reload_at = time.monotonic() + Config.EXPIRY_RELOAD_INTERVAL
+
+        while True:
+            self._changed.clear()
+            now = datetime.now()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, user_id, server, date_payed, day = heapq.heappop(self._heap)
+                if self._subscriptions.get((user_id, server)) != date_payed:
+                    continue
+                try:
+                    await self._fire(user_id, server, date_payed, day)
+                except Exception as e:
+                    logger.exception(f"Ошибка планировщика подписок для пользователя {user_id} на сервере {server}: {e}")
+
+            if time.monotonic() >= check_at:
+                if not await self._leader_lock.held():
+                    logger.warning("Блокировка планировщика окончания подписок потеряна, срабатывания передаются другому процессу")
+                    return
+                check_at = time.monotonic() + Config.EXPIRY_LEADER_CHECK
+            if time.monotonic() >= reload_at:
+                await self._reload()
+                reload_at = time.monotonic() + Config.EXPIRY_RELOAD_INTERVAL
+
+            # Ожидание ограничено проверкой блокировки, поэтому перевод системных часов не откладывает срабатывание надолго
+            timeout = max(0.0, check_at - time.monotonic())
+            if self._heap:
+                timeout = min(timeout, max(0.0, (self._heap[0][0] - datetime.now()).total_seconds()))
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        return {'leader': self.leader, 'subscriptions': len(self._subscriptions), 'scheduled': len(self._heap), 'fired': self.fired}
+
+    async def close(self):
+        if self._task is None:
+            return
+        remove_payment_listener(self.payment_changed)
+        self._task.cancel()
+        await asyncio.gather(self._task, *self._refreshing, return_exceptions=True)
+        self._task = None
+        self._loop = None
+        logger.info(f"Планировщик окончания подписок остановлен: {self.stats()}")
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,166 @@
+# jobs.py
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from collections import Counter
+from config import Config
+from db import claim_jobs, complete_job, fail_job
+from db_async import run_db
+from locks import AdvisoryLock
+from metrics import JOB_RESULTS, JOB_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class JobRetry(Exception):
+    # Временная ошибка: задача будет повторена с экспоненциальной задержкой
+    pass
+
+class Job:
+    __slots__ = ('id', 'key', 'kind', 'payload', 'attempts', 'max_attempts', 'token')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.key = row['job_key']
+        self.kind = row['kind']
+        self.payload = row['payload']
+        self.attempts = row['attempts']
+        self.max_attempts = row['max_attempts']
+        self.token = row['token']
+
+def retry_delay(attempts):
+    delay = min(Config.JOB_RETRY_MAX, Config.JOB_RETRY_BASE * 2 ** (attempts - 1))
+    # Разброс не даёт задачам, упавшим одновременно, повторяться одной волной
+    return delay * random.uniform(0.8, 1.2)
+
+class JobRunner:
+    def __init__(self, workers=None, lease_seconds=None, poll_interval=None):
+        self.workers = workers or Config.JOB_WORKERS
+        self.lease_seconds = lease_seconds or Config.JOB_LEASE_SECONDS
+        self.poll_interval = poll_interval or Config.JOB_POLL_INTERVAL
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.context = {}
+        self.running = 0
+        self.outcomes = Counter()
+        self._handlers = {}
+        self._failure_handlers = {}
+        self._locks = {}
+        self._tasks = []
+        self._wakeup = None
+        self._stopping = False
+
+    def register(self, kind, handler, on_failure=None, lock=None):
+        # handler(job, context) выполняет задачу; on_failure(job, context, error) вызывается после последней попытки.
+        # lock(job) возвращает имя блокировки: задачи с одним именем не выполняются одновременно ни в одном процессе
+        self._handlers[kind] = handler
+        if on_failure is not None:
+            self._failure_handlers[kind] = on_failure
+        if lock is not None:
+            self._locks[kind] = lock
+
+    async def _run_handler(self, handler, job):
+        lock_for = self._locks.get(job.kind)
+        if lock_for is None:
+            await handler(job, self.context)
+            return
+        # Защищает и от задачи с истёкшей арендой, которую успел забрать другой процесс, пока эта ещё выполняется
+        async with AdvisoryLock(lock_for(job)) as acquired:
+            if not acquired:
+                raise JobRetry("Клиент занят другой задачей")
+            await handler(job, self.context)
+
+    def start(self, **context):
+        self.context.update(context)
+        if self._tasks:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Запущено обработчиков задач: {self.workers} ({self.worker_id})")
+
+    def wake(self):
+        # Новая задача в этом процессе выполняется сразу, не дожидаясь следующего опроса
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _claim(self, limit, kinds=None):
+        rows = await run_db(claim_jobs, self.worker_id, limit, self.lease_seconds, kinds)
+        if rows is None:
+            return None
+        return [Job(row) for row in rows]
+
+    async def _execute(self, job):
+        handler = self._handlers.get(job.kind)
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            if handler is None:
+                raise JobRetry(f"Нет обработчика для задач типа {job.kind}")
+            await self._run_handler(handler, job)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            if job.attempts < job.max_attempts:
+                delay = retry_delay(job.attempts)
+                outcome = 'retry'
+                logger.warning(f"Задача {job.key} (попытка {job.attempts}/{job.max_attempts}) завершилась ошибкой: {error}, повтор через {delay:.0f} с")
+            else:
+                delay = None
+                outcome = 'failed'
+                logger.error(f"Задача {job.key} окончательно завершилась ошибкой после {job.attempts} попыток: {error}")
+            await run_db(fail_job, job.id, job.token, error, delay)
+
+            on_failure = self._failure_handlers.get(job.kind)
+            if delay is None and on_failure is not None:
+                try:
+                    await on_failure(job, self.context, e)
+                except Exception as failure_error:
+                    logger.exception(f"Ошибка при обработке неудачи задачи {job.key}: {failure_error}")
+        else:
+            outcome = 'done'
+            if not await run_db(complete_job, job.id, job.token):
+                logger.warning(f"Задача {job.key} выполнена, но её аренда уже истекла")
+        finally:
+            self.running -= 1
+
+        self.outcomes[outcome] += 1
+        JOB_RESULTS.inc(kind=job.kind, outcome=outcome)
+        JOB_SECONDS.observe(time.perf_counter() - started, kind=job.kind)
+
+    async def _worker(self):
+        while not self._stopping:
+            # Событие сбрасывается до запроса, чтобы не потерять пробуждение, пришедшее во время него
+            self._wakeup.clear()
+            jobs = await self._claim(1)
+            if jobs:
+                for job in jobs:
+                    await self._execute(job)
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self, kinds=None, limit=None, **context):
+        # Выполняет готовые к запуску задачи, пока они есть; задачи, отложенные до повтора, остаются в очереди
+        self.context.update(context)
+        while True:
+            jobs = await self._claim(limit or self.workers, kinds)
+            if not jobs:
+                return
+            await asyncio.gather(*(self._execute(job) for job in jobs))
+
+    def stats(self):
+        return {'running': self.running, **self.outcomes}
+
+    async def close(self):
+        if not self._tasks:
+            return
+        # Обработчики завершают текущую задачу; незавершённые задачи подхватят после перезапуска по истечении аренды
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Обработчики задач остановлены: {self.stats()}")
@@ -1,10 +1,11 @@
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram import types
+from servers import get_registry
 
 def get_main_menu_keyboard():
     keyboard_builder = ReplyKeyboardBuilder()
-    keyboard_builder.add(types.KeyboardButton(text="Купить 'Финляндия'"))
-    keyboard_builder.add(types.KeyboardButton(text="Купить 'США'"))
+    for region in get_registry().regions.values():
+        keyboard_builder.add(types.KeyboardButton(text=region.button_text))
     keyboard_builder.add(types.KeyboardButton(text="Контакты"))
     return keyboard_builder.as_markup(resize_keyboard=True)
 
@@ -0,0 +1,77 @@
+# locks.py
+import hashlib
+import logging
+from mysql.connector import Error
+from config import Config
+from db import get_lock_pool, acquire_lock, is_lock_held, release_lock
+from db_async import run_db
+
+logger = logging.getLogger(__name__)
+
+# Общая блокировка скриптов обслуживания таблицы clients: check_clients.py и reconcile.py
+MAINTENANCE_LOCK = 'clients_maintenance'
+
+def lock_name(name):
+    # Имена блокировок общие для всего сервера MySQL и ограничены 64 символами, поэтому включают имя базы
+    full_name = f"{Config.DB_NAME}:{name}"
+    if len(full_name) > 64:
+        full_name = hashlib.sha1(full_name.encode()).hexdigest()
+    return full_name
+
+class AdvisoryLock:
+    # Блокировка между процессами бота и скриптами обслуживания на всех хостах.
+    # GET_LOCK действует, пока живо соединение, поэтому на время владения оно забирается из отдельного пула блокировок:
+    # задачи под блокировкой выполняют свои запросы через основной пул и не ждут соединений, занятых блокировками
+    def __init__(self, name, timeout=0):
+        self.name = name
+        self.timeout = timeout
+        self._lock_name = lock_name(name)
+        self._connection = None
+
+    @property
+    def acquired(self):
+        return self._connection is not None
+
+    def _acquire(self):
+        if self._connection is not None:
+            return True
+        pool = get_lock_pool()
+        try:
+            connection = pool.acquire()
+        except Error as e:
+            logger.error(f"Не удалось получить соединение для блокировки {self.name}: {e}")
+            return False
+        if not acquire_lock(connection, self._lock_name, self.timeout):
+            pool.release(connection)
+            return False
+        self._connection = connection
+        return True
+
+    def _held(self):
+        return self._connection is not None and is_lock_held(self._connection, self._lock_name)
+
+    def _release(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if release_lock(connection, self._lock_name):
+            get_lock_pool().release(connection)
+        else:
+            # Живое соединение вернулось бы в пул вместе с блокировкой; после закрытия её снимет сервер
+            get_lock_pool().discard(connection)
+
+    async def acquire(self):
+        return await run_db(self._acquire)
+
+    async def held(self):
+        # Соединение могло оборваться, и тогда блокировку уже захватил другой процесс
+        return await run_db(self._held)
+
+    async def release(self):
+        await run_db(self._release)
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
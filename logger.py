@@ -1,10 +1,111 @@
+import atexit
+import copy
+import json
 import logging
+import queue
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+from metrics import LOG_RECORDS_DROPPED
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord; всё остальное пришло через extra и попадает в JSON как есть
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    # Записи с extra={'sample': <ключ>} пропускаются не чаще burst раз за interval секунд на ключ.
+    # Первая запись нового окна сообщает, сколько похожих записей было пропущено в предыдущем
+    def __init__(self, burst=None, interval=None):
+        super().__init__()
+        self.burst = burst if burst is not None else Config.LOG_SAMPLE_BURST
+        self.interval = interval if interval is not None else Config.LOG_SAMPLE_INTERVAL
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            started, passed, dropped = self._windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                if dropped:
+                    record.sampled_out = dropped
+                    record.msg = f"{record.msg} (пропущено похожих записей: {dropped})"
+                started, passed, dropped = now, 0, 0
+            if passed < self.burst:
+                self._windows[key] = (started, passed + 1, dropped)
+                return True
+            self._windows[key] = (started, passed, dropped + 1)
+        LOG_RECORDS_DROPPED.inc(reason='sampled')
+        return False
+
+class NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Аргументы подставляются сразу, пока объекты не изменились; форматирование строки и трассировки выполняет поток записи
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        # Переполненная очередь не должна останавливать цикл событий: запись отбрасывается
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason='queue_full')
+
+_listener = None
 
 def setup_logging():
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if Config.LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    # Запись в поток вывода выполняет отдельный поток, обработчики на цикле событий только кладут запись в очередь
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=Config.LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(Config.LOG_LEVEL)
+
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    # Дописывает оставшиеся в очереди записи
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
 
 setup_logging()
 
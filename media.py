@@ -0,0 +1,100 @@
+# media.py
+import asyncio
+import hashlib
+import logging
+import os
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.types import BufferedInputFile
+from cache import TTLCache, MISSING
+from config import Config
+from db_async import get_media_file_id, save_media_file_id, delete_media_file_id
+from notifier import notifier, PRIORITY_NORMAL
+
+logger = logging.getLogger(__name__)
+
+# file_id по ключу (bot_id, sha256 содержимого); None — файл ещё не загружался
+_file_ids = TTLCache(maxsize=Config.MEDIA_CACHE_SIZE, ttl=Config.MEDIA_CACHE_TTL)
+# Содержимое файлов с диска по пути: (mtime, данные)
+_assets = {}
+_upload_locks = {}
+
+def load_asset(path):
+    # Файл перечитывается только после изменения на диске
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _assets.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        data = f.read()
+    _assets[path] = (mtime, data)
+    return data
+
+async def _cached_file_id(key, persist):
+    file_id = _file_ids.get(key)
+    if file_id is not MISSING:
+        return file_id
+    file_id = await get_media_file_id(*key) if persist else None
+    _file_ids.set(key, file_id)
+    return file_id
+
+async def _upload_photo(bot, key, chat_id, data, filename, caption, priority, persist, **kwargs):
+    try:
+        result = await notifier.submit(bot.send_photo, chat_id, BufferedInputFile(data, filename=filename),
+                                       caption=caption, priority=priority, **kwargs)
+    except TelegramAPIError as e:
+        logger.error(f"Ошибка при отправке фото пользователю {chat_id}: {e}")
+        return None
+    logger.info(f"Фото {filename} загружено и отправлено пользователю {chat_id}", extra={'sample': 'send'})
+
+    if result is not None and result.photo:
+        # Последний размер — исходное изображение; по его file_id Telegram отправит ту же картинку
+        file_id = result.photo[-1].file_id
+        _file_ids.set(key, file_id)
+        if persist:
+            await save_media_file_id(*key, file_id)
+    return result
+
+def _is_stale_file_id(error):
+    # "wrong file identifier/HTTP URL specified", "wrong remote file identifier specified", "file_id ..."
+    message = str(error).lower()
+    return 'file identifier' in message or 'file_id' in message
+
+async def send_cached_photo(bot, chat_id, data, filename, caption=None, priority=PRIORITY_NORMAL, persist=True, **kwargs):
+    # Файл загружается в Telegram один раз, дальше отправляется по file_id.
+    # persist=False — file_id хранится только в памяти (одноразовые картинки, которые могут понадобиться лишь при повторе)
+    key = (bot.id, hashlib.sha256(data).hexdigest())
+
+    file_id = await _cached_file_id(key, persist)
+    if file_id is None and persist:
+        # Одновременные первые отправки общего файла ждут одну загрузку, а не загружают его каждая
+        async with _upload_locks.setdefault(key, asyncio.Lock()):
+            file_id = await _cached_file_id(key, persist)
+            if file_id is None:
+                return await _upload_photo(bot, key, chat_id, data, filename, caption, priority, persist, **kwargs)
+
+    if file_id is not None:
+        try:
+            result = await notifier.submit(bot.send_photo, chat_id, file_id, caption=caption, priority=priority, **kwargs)
+            logger.info(f"Фото {filename} отправлено пользователю {chat_id} по file_id", extra={'sample': 'send'})
+            return result
+        except TelegramBadRequest as e:
+            if not _is_stale_file_id(e):
+                # Например, chat not found: повторная загрузка получила бы ту же ошибку, а file_id ещё действителен
+                logger.error(f"Ошибка при отправке фото пользователю {chat_id}: {e}")
+                return None
+            # file_id больше не принимается Telegram — загружаем файл заново
+            logger.warning(f"Telegram отклонил file_id для {filename}: {e}, файл будет загружен заново")
+            _file_ids.invalidate(key)
+            if persist:
+                await delete_media_file_id(*key)
+        except TelegramAPIError as e:
+            logger.error(f"Ошибка при отправке фото пользователю {chat_id}: {e}")
+            return None
+
+    return await _upload_photo(bot, key, chat_id, data, filename, caption, priority, persist, **kwargs)
+
+def stats():
+    return _file_ids.stats()
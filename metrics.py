@@ -0,0 +1,228 @@
+# metrics.py
+import bisect
+import functools
+import logging
+import threading
+import time
+from aiohttp import web
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах: от быстрых запросов к базе до медленных ответов wg-easy
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Метрики обновляются и из цикла событий, и из потоков пула базы данных
+        self._lock = threading.Lock()
+        self._values = {}
+        # Значение, которое дешевле прочитать при запросе метрик, чем поддерживать при каждом изменении.
+        # Для метрики с метками функция возвращает словарь {значения меток: значение}
+        self._function = None
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def set_function(self, function):
+        self._function = function
+
+    def _function_samples(self, suffix):
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.error(f"Ошибка при вычислении метрики {self.name}: {e}")
+            return []
+        if not self.labelnames:
+            return [(suffix, (), (), value)]
+        return [(suffix, key if isinstance(key, tuple) else (key,), (), item) for key, item in value.items()]
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labelvalues, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        if self._function is not None:
+            return self._function_samples('_total')
+        with self._lock:
+            return [('_total', key, (), value) for key, value in self._values.items()]
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        if self._function is not None:
+            return self._function_samples('')
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), count))
+        return samples
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+HANDLER_SECONDS = Histogram('bot_handler_duration_seconds', "Время выполнения обработчиков aiogram", ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors', "Исключения в обработчиках aiogram", ('handler',))
+UPDATES_DROPPED = Counter('bot_updates_dropped', "Обновления, отброшенные до обработчиков", ('reason',))
+
+DB_QUERIES = Counter('bot_db_calls', "Вызовы функций db.py", ('function',))
+DB_SECONDS = Histogram('bot_db_duration_seconds', "Время выполнения функций db.py", ('function',))
+DB_ERRORS = Counter('bot_db_errors', "Ошибки базы данных в функциях db.py", ('function',))
+
+WG_REQUESTS = Counter('bot_wg_requests', "Запросы к API wg-easy", ('server', 'method', 'endpoint'))
+WG_SECONDS = Histogram('bot_wg_request_duration_seconds', "Время выполнения запросов к API wg-easy", ('server', 'method', 'endpoint'))
+WG_ERRORS = Counter('bot_wg_errors', "Неудачные запросы к API wg-easy", ('server', 'method', 'endpoint'))
+
+FSM_CACHED = Gauge('bot_fsm_cached_states', "Состояния FSM в памяти хранилища")
+FSM_DIRTY = Gauge('bot_fsm_dirty_states', "Состояния FSM, ожидающие записи в базу")
+NOTIFICATIONS_PENDING = Gauge('bot_notifications_pending', "Сообщения в очереди диспетчера уведомлений")
+JOBS_RUNNING = Gauge('bot_jobs_running', "Задачи wg-easy, выполняемые этим процессом")
+EXPIRY_SUBSCRIPTIONS = Gauge('bot_expiry_subscriptions', "Подписки, отслеживаемые планировщиком окончания")
+JOB_RESULTS = Counter('bot_job_results', "Результаты выполнения задач wg-easy", ('kind', 'outcome'))
+JOB_SECONDS = Histogram('bot_job_duration_seconds', "Время выполнения задач wg-easy", ('kind',))
+DB_POOL_IN_USE = Gauge('bot_db_pool_in_use', "Занятые соединения пула базы данных")
+CACHE_ENTRIES = Gauge('bot_cache_entries', "Записи в кэшах процесса", ('cache',))
+CACHE_LOOKUPS = Counter('bot_cache_lookups', "Обращения к кэшам процесса", ('cache', 'result'))
+CACHE_INVALIDATIONS = Counter('bot_cache_invalidations', "Сброшенные записи кэшей процесса", ('cache',))
+NOTIFICATIONS_SENT = Counter('bot_notifications', "Результаты отправки сообщений диспетчером уведомлений", ('outcome',))
+LOG_RECORDS_DROPPED = Counter('bot_log_records_dropped', "Записи журнала, отброшенные выборкой или при переполнении очереди", ('reason',))
+
+_db_call = threading.local()
+
+def observe_db(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Имя текущей функции нужно db_error(): функции db.py сами перехватывают ошибки и возвращают значение по умолчанию
+        previous = getattr(_db_call, 'name', None)
+        _db_call.name = name
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(function=name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, function=name)
+            DB_QUERIES.inc(function=name)
+            _db_call.name = previous
+    return wrapper
+
+def db_error():
+    DB_ERRORS.inc(function=getattr(_db_call, 'name', None) or 'unknown')
+
+class HandlerMetricsMiddleware:
+    # Внутренний middleware: вызывается только для обновлений, для которых нашёлся обработчик
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+async def _metrics_view(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+_runner = None
+
+async def start_metrics_server(host=None, port=None):
+    global _runner
+    host = host or Config.METRICS_HOST
+    port = port if port is not None else Config.METRICS_PORT
+    if not port or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Занятый порт не должен мешать запуску бота: он работает дальше без эндпоинта метрик
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return
+    _runner = runner
+    logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
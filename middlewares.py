@@ -0,0 +1,114 @@
+# middlewares.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from aiogram import BaseMiddleware
+from config import Config
+from db import begin_unit_of_work, end_unit_of_work
+from db_async import commit_unit_of_work, rollback_unit_of_work, release_unit_slot
+from metrics import UPDATES_DROPPED
+
+logger = logging.getLogger(__name__)
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    # Ограничивает число одновременно обрабатываемых обновлений; остальные ждут своей очереди
+    def __init__(self, limit=None):
+        self.limit = limit or Config.UPDATE_CONCURRENCY
+        self._semaphore = asyncio.Semaphore(self.limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+class ThrottleMiddleware(BaseMiddleware):
+    # Скользящее окно на пользователя: не больше rate обновлений за window секунд, лишние отбрасываются до обработчиков.
+    # Администратор не ограничивается — он подтверждает платежи пачками
+    def __init__(self, rate=None, window=None, users_limit=None):
+        self.rate = rate or Config.THROTTLE_RATE
+        self.window = window or Config.THROTTLE_WINDOW
+        self.users_limit = users_limit or Config.THROTTLE_USERS_LIMIT
+        self._hits = OrderedDict()
+
+    def _allow(self, user_id):
+        now = time.monotonic()
+        hits = self._hits.get(user_id)
+        if hits is None:
+            hits = self._hits[user_id] = deque()
+            # Окна давно неактивных пользователей вытесняются первыми
+            while len(self._hits) > self.users_limit:
+                self._hits.popitem(last=False)
+        else:
+            self._hits.move_to_end(user_id)
+
+        while hits and now - hits[0] >= self.window:
+            hits.popleft()
+        if len(hits) >= self.rate:
+            return False
+        hits.append(now)
+        return True
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None or str(user.id) == str(Config.TELEGRAM_ID) or self._allow(user.id):
+            return await handler(event, data)
+
+        UPDATES_DROPPED.inc(reason='throttled')
+        logger.warning(f"Обновление от пользователя {user.id} отброшено: превышен лимит {self.rate} за {self.window} с",
+                       extra={'sample': 'throttle'})
+        if event.callback_query is not None:
+            await event.callback_query.answer("Слишком много запросов, попробуйте позже.")
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    # Повторное нажатие той же кнопки (action, chat_id, server), пока первое ещё обрабатывается или только что обработано,
+    # отбрасывается. Окно после завершения ловит двойные нажатия, пришедшие уже после быстрого ответа обработчика
+    def __init__(self, cooldown=None):
+        self.cooldown = cooldown if cooldown is not None else Config.CALLBACK_DEDUP_COOLDOWN
+        self._in_flight = set()
+        self._finished = OrderedDict()
+
+    def _recent(self, key, now):
+        while self._finished:
+            oldest_key, finished_at = next(iter(self._finished.items()))
+            if now - finished_at < self.cooldown:
+                break
+            del self._finished[oldest_key]
+        return key in self._finished
+
+    async def __call__(self, handler, event, data):
+        key = tuple(event.data.split('_')) if event.data else None
+        if key is None:
+            return await handler(event, data)
+
+        if key in self._in_flight or self._recent(key, time.monotonic()):
+            UPDATES_DROPPED.inc(reason='duplicate_callback')
+            logger.info(f"Повторный callback {event.data} отброшен")
+            await event.answer("Этот запрос уже обрабатывается.")
+            return
+
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+            self._finished[key] = time.monotonic()
+            self._finished.move_to_end(key)
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызовы db.py в обработчике идут через одно соединение и одну транзакцию,
+    # которая фиксируется после обработчика или откатывается, если он завершился исключением
+    async def __call__(self, handler, event, data):
+        unit, token = begin_unit_of_work(asyncio.current_task())
+        try:
+            result = await handler(event, data)
+        except Exception:
+            await rollback_unit_of_work()
+            raise
+        else:
+            if not await commit_unit_of_work():
+                logger.error("Изменения обработчика не сохранены в базе данных")
+            return result
+        finally:
+            # Обработчик мог быть отменён во время запроса; слот соединения всё равно возвращается
+            release_unit_slot(unit)
+            end_unit_of_work(unit, token)
@@ -0,0 +1,219 @@
+# migrations.py
+import logging
+import sys
+from mysql.connector import Error
+from db import (
+    get_db_connection,
+    LAST_PAYMENT_DATE_QUERY,
+    WG_CLIENT_QUERY,
+    CLIENTS_TO_WARN_QUERY,
+    CLIENTS_TO_REMOVE_QUERY,
+    SUBSCRIPTION_QUERY,
+    SERVER_CLIENTS_QUERY,
+    REMOVE_CLIENTS_QUERY,
+    CLAIM_JOBS_QUERY,
+    CLAIMED_JOBS_QUERY,
+    LOAD_USER_STATE_QUERY,
+)
+
+logger = logging.getLogger(__name__)
+
+def _column_exists(cursor, table, column):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)
+    )
+    return cursor.fetchone()[0] > 0
+
+def _index_exists(cursor, table, index):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index)
+    )
+    return cursor.fetchone()[0] > 0
+
+def _add_column(cursor, table, column, definition):
+    # Таблицы могли быть созданы вручную до появления миграций, поэтому проверяем наличие столбца
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _add_index(cursor, table, index, columns):
+    if not _index_exists(cursor, table, index):
+        cursor.execute(f"CREATE INDEX {index} ON {table} ({columns})")
+
+def _create_base_tables(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        chat_id BIGINT NOT NULL PRIMARY KEY,
+        date_start DATETIME NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS clients (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        date_payed DATETIME NOT NULL,
+        server VARCHAR(64) NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_states (
+        user_id BIGINT NOT NULL PRIMARY KEY,
+        state VARCHAR(255) NULL
+    )
+    """)
+
+def _add_wg_client_id(cursor):
+    _add_column(cursor, 'clients', 'wg_client_id', 'VARCHAR(64) NULL')
+
+def _add_user_state_data(cursor):
+    _add_column(cursor, 'user_states', 'data', 'TEXT NULL')
+
+def _add_client_indexes(cursor):
+    # Последняя оплата пользователя: WHERE user_id AND server ORDER BY date_payed DESC LIMIT 1
+    _add_index(cursor, 'clients', 'idx_clients_user_server_date', 'user_id, server, date_payed')
+    # Выборки check_clients.py: WHERE server AND date_payed в диапазоне
+    _add_index(cursor, 'clients', 'idx_clients_server_date', 'server, date_payed')
+
+def _add_client_node(cursor):
+    # Узел wg-easy внутри региона; NULL у клиентов, созданных до появления реестра серверов
+    _add_column(cursor, 'clients', 'node', 'VARCHAR(64) NULL')
+
+def _create_jobs_table(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        job_key VARCHAR(191) NOT NULL,
+        kind VARCHAR(32) NOT NULL,
+        payload TEXT NOT NULL,
+        status VARCHAR(16) NOT NULL,
+        attempts INT NOT NULL DEFAULT 0,
+        max_attempts INT NOT NULL,
+        run_at DATETIME NOT NULL,
+        locked_by VARCHAR(128) NULL,
+        locked_until DATETIME NULL,
+        last_error TEXT NULL,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        UNIQUE KEY uq_jobs_job_key (job_key)
+    )
+    """)
+    # Захват готовых задач: WHERE status AND run_at/locked_until ORDER BY run_at
+    _add_index(cursor, 'jobs', 'idx_jobs_status_run_at', 'status, run_at')
+    _add_index(cursor, 'jobs', 'idx_jobs_locked_by', 'locked_by')
+
+def _create_media_files_table(cursor):
+    # file_id действителен только для загрузившего его бота, поэтому бот входит в ключ
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS media_files (
+        bot_id BIGINT NOT NULL,
+        content_hash CHAR(64) NOT NULL,
+        file_id VARCHAR(255) NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (bot_id, content_hash)
+    )
+    """)
+
+MIGRATIONS = [
+    (1, "Базовые таблицы users, clients, user_states", _create_base_tables),
+    (2, "ID клиента wg-easy в clients", _add_wg_client_id),
+    (3, "Данные FSM в user_states", _add_user_state_data),
+    (4, "Составные индексы clients", _add_client_indexes),
+    (5, "Узел wg-easy в clients", _add_client_node),
+    (6, "Очередь задач wg-easy", _create_jobs_table),
+    (7, "file_id загруженных в Telegram файлов", _create_media_files_table),
+]
+
+def get_schema_version(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT NOT NULL PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at DATETIME NOT NULL
+    )
+    """)
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cursor.fetchone()[0]
+
+def apply_migrations():
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return False
+
+        try:
+            with connection.cursor() as cursor:
+                current_version = get_schema_version(cursor)
+                for version, description, migrate in MIGRATIONS:
+                    if version <= current_version:
+                        continue
+                    logger.info(f"Применение миграции {version}: {description}")
+                    # DDL в MySQL фиксируется неявно, поэтому версия записывается сразу после каждого шага
+                    migrate(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, NOW())",
+                        (version, description)
+                    )
+                    connection.commit()
+                    current_version = version
+            logger.info(f"Схема базы данных актуальна, версия {current_version}")
+            return True
+        except Error as e:
+            logger.error(f"Ошибка при применении миграций: {e}")
+            return False
+
+# Запросы db.py, которые выполняются на горячем пути или сканируют clients по диапазону дат
+# Проверяются те же строки SQL, что выполняет db.py; EXPLAIN для UPDATE и DELETE ничего не изменяет
+HOT_QUERIES = [
+    ("get_last_payment_date", LAST_PAYMENT_DATE_QUERY, (0, 'Finland')),
+    ("get_wg_client", WG_CLIENT_QUERY, (0, 'Finland')),
+    ("get_clients_to_warn", CLIENTS_TO_WARN_QUERY, ('Finland', 'Finland', 30, 33)),
+    ("get_clients_to_remove", CLIENTS_TO_REMOVE_QUERY, ('Finland', 'Finland', 33)),
+    ("get_subscription", SUBSCRIPTION_QUERY, (0, 'Finland')),
+    ("get_server_clients", SERVER_CLIENTS_QUERY, ('Finland', 'Finland')),
+    ("remove_clients_from_db", REMOVE_CLIENTS_QUERY.format(placeholders="%s"), ('Finland', 0)),
+    ("claim_jobs", CLAIM_JOBS_QUERY.format(kind_filter=""), ('explain', 300, 10)),
+    ("claimed_jobs", CLAIMED_JOBS_QUERY, ('explain',)),
+    ("load_user_state", LOAD_USER_STATE_QUERY, (0,)),
+]
+
+def check_query_plans():
+    # Возвращает список запросов, для которых EXPLAIN показывает полное сканирование таблицы
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось установить соединение с базой данных")
+            return None
+
+        full_scans = []
+        try:
+            with connection.cursor(dictionary=True) as cursor:
+                for name, query, params in HOT_QUERIES:
+                    cursor.execute(f"EXPLAIN {query}", params)
+                    for row in cursor.fetchall():
+                        if row.get('type') == 'ALL':
+                            full_scans.append((name, row.get('table'), row.get('possible_keys')))
+            return full_scans
+        except Error as e:
+            logger.error(f"Ошибка при проверке планов запросов: {e}")
+            return None
+
+def main(argv):
+    if not apply_migrations():
+        return 1
+
+    if '--explain' in argv:
+        full_scans = check_query_plans()
+        if full_scans is None:
+            return 1
+        for name, table, possible_keys in full_scans:
+            logger.error(f"Запрос {name} выполняет полное сканирование таблицы {table} (возможные индексы: {possible_keys})")
+        if full_scans:
+            return 1
+        logger.info(f"Все {len(HOT_QUERIES)} запросов используют индексы")
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
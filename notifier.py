@@ -0,0 +1,151 @@
+# notifier.py
+import asyncio
+import itertools
+import logging
+import time
+from collections import Counter
+from aiogram.exceptions import TelegramRetryAfter
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Меньшее значение — выше приоритет: ответы при подключении идут раньше предупреждений об окончании подписки
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Токен резервируется сразу, а вызывающий ждёт возвращённое время, поэтому очередь ожидающих справедлива
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class _Job:
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'future')
+
+    def __init__(self, method, chat_id, args, kwargs, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+
+class NotificationDispatcher:
+    def __init__(self, global_rate=None, per_chat_rate=None, per_chat_burst=None, workers=None, max_retries=None):
+        self.global_rate = global_rate or Config.NOTIFY_GLOBAL_RATE
+        self.per_chat_rate = per_chat_rate or Config.NOTIFY_PER_CHAT_RATE
+        self.per_chat_burst = per_chat_burst or Config.NOTIFY_PER_CHAT_BURST
+        self.workers = workers or Config.NOTIFY_WORKERS
+        self.max_retries = max_retries if max_retries is not None else Config.NOTIFY_MAX_RETRIES
+
+        self._queue = None
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(self.global_rate, self.global_rate)
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self._tasks = []
+        self.outcomes = Counter()
+
+    def _ensure_started(self):
+        if not self._tasks:
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, method, chat_id, *args, priority=PRIORITY_NORMAL, **kwargs):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), _Job(method, chat_id, args, kwargs, future)))
+        return await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= Config.NOTIFY_CHAT_BUCKETS_LIMIT:
+                # Полные корзины ничем не отличаются от новых, их можно безопасно выбросить
+                for idle_chat_id in [c for c, b in self._chat_buckets.items() if b.is_full()]:
+                    del self._chat_buckets[idle_chat_id]
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_for_slot(self, chat_id):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        delay = self._chat_bucket(chat_id).reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        delay = self._global_bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_slot(job.chat_id)
+            try:
+                result = await job.method(job.chat_id, *job.args, **job.kwargs)
+            except TelegramRetryAfter as e:
+                self.outcomes['retry_after'] += 1
+                if attempt == self.max_retries:
+                    self.outcomes['dropped'] += 1
+                    raise
+                # Ограничение Telegram действует на весь бот, поэтому приостанавливаем всех обработчиков очереди
+                logger.warning(f"Превышен лимит Telegram при отправке пользователю {job.chat_id}, повтор через {e.retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                continue
+            except Exception:
+                self.outcomes['failed'] += 1
+                raise
+            self.outcomes['sent'] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+            return
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            **self.outcomes
+        }
+
+    async def close(self):
+        if not self._tasks:
+            return
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Диспетчер уведомлений остановлен: {self.stats()}")
+
+notifier = NotificationDispatcher()
@@ -1,23 +1,141 @@
 from datetime import datetime
-import qrcode
-import os
 from aiogram import types
-from aiogram.types import FSInputFile
 from aiogram.fsm.context import FSMContext
-from config import Config
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.exceptions import TelegramAPIError
 from states import BuyProcess
-from db import get_user_by_chat_id, update_user_payment, set_user_state, get_last_payment_date
-from wg import WgEasyAPI
-from keyboards import get_main_menu_keyboard
-from utils import safe_send_message, safe_send_photo
+from db_async import (
+    get_last_payment_date,
+    get_wg_client,
+    set_wg_client_id,
+    enqueue_job,
+    enqueue_payment_job,
+    commit_unit_of_work
+)
+from servers import get_registry
+from keyboards import get_main_menu_keyboard, get_approval_inline_keyboard
+from provisioning import job_runner, client_lock
+from jobs import JobRetry
+from utils import safe_send_message
+from media import send_cached_photo
+from notifier import PRIORITY_HIGH
+from qr import render_qr
 from logger import logger
 
-qr_code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qrcodes')
+def get_user_context(bot, fsm_storage: BaseStorage, chat_id) -> FSMContext:
+    # Колбэк приходит от администратора, а состояние нужно менять у пользователя, чей платёж проверяется
+    key = StorageKey(bot_id=bot.id, chat_id=int(chat_id), user_id=int(chat_id))
+    return FSMContext(storage=fsm_storage, key=key)
 
-if not os.path.exists(qr_code_dir):
-    os.makedirs(qr_code_dir)
-
-async def handle_approval(query: types.CallbackQuery, state: FSMContext):
+async def edit_admin_caption(bot, payload, caption, reply_markup=None):
+    # Задачи, поставленные не из одобрения платежа (например, reconcile.py), не связаны с сообщением администратора
+    if 'admin_message_id' not in payload:
+        return
+    # Ошибка Telegram при обновлении подписи не должна приводить к повтору уже выполненной работы с wg-easy
+    try:
+        await bot.edit_message_caption(
+            chat_id=payload['admin_chat_id'],
+            message_id=payload['admin_message_id'],
+            caption=caption,
+            reply_markup=reply_markup
+        )
+    except TelegramAPIError as e:
+        logger.warning(f"Не удалось обновить сообщение администратора {payload['admin_message_id']}: {e}")
+
+async def create_client_job(job, context):
+    bot = context['bot']
+    chat_id, server = job.payload['chat_id'], job.payload['server']
+    registry = get_registry()
+
+    # Клиент мог быть создан предыдущей попыткой или другой задачей той же оплаты (например, задачей сверки,
+    # поставленной, пока эта ждала повтора): такой клиент используется, а не создаётся дубликат.
+    # Новому пользователю при первой попытке хватает сохранённых списков узлов: свежие запрашиваются, только если клиент мог появиться
+    expect_existing = job.attempts > 1 or await get_wg_client(chat_id, server) is not None
+    node, client_id = await registry.find_client(server, chat_id, refresh=expect_existing)
+    if client_id is not None and not await node.api.enable_client(client_id):
+        raise JobRetry(f"Не удалось включить существующего клиента {chat_id} на узле {node.name}")
+
+    if client_id is None:
+        # Новый клиент создаётся на наименее загруженном узле выбранного региона
+        node = await registry.pick_node(server)
+        creation_response = await node.api.create_client(chat_id)
+        if creation_response is None:
+            raise JobRetry(f"Не удалось создать клиента {chat_id} на узле {node.name}")
+        logger.info(f"Ответ от WireGuard API при создании клиента: {creation_response}")
+
+        # wg-easy не возвращает ID созданного клиента, поэтому ищем его один раз и сохраняем в базе
+        client_id = await node.api.find_client_id(chat_id)
+        if client_id is None:
+            raise JobRetry(f"Клиент с chat_id {chat_id} не найден среди списка клиентов на узле {node.name}")
+
+    await set_wg_client_id(chat_id, server, client_id, node.name)
+    client_config = await node.api.get_config_client(client_id)
+    if client_config is None:
+        raise JobRetry(f"Ошибка при получении конфигурации для клиента {chat_id}")
+
+    qr_code_png = await render_qr(client_config)
+    # При повторе задачи та же картинка отправляется по file_id без повторной загрузки
+    await send_cached_photo(bot, chat_id, qr_code_png, f"wg_qrcode_{chat_id}_{server}.png",
+                            caption="Успешно! Вот ваш QR-код для подключения WireGuard.", priority=PRIORITY_HIGH, persist=False)
+
+    await safe_send_message(bot, chat_id,
+                            f"Вот ваша конфигурация WireGuard для сервера {server}:\n\n{client_config}", priority=PRIORITY_HIGH)
+    logger.info(f"Клиент с chat_id {chat_id} одобрен на сервере {server} (узел {node.name}), и QR-код с конфигурацией отправлены.")
+
+    await edit_admin_caption(bot, job.payload, f"Платёж пользователя {chat_id} на сервер {server} был одобрен.")
+
+    await get_user_context(bot, context['fsm_storage'], chat_id).set_state(BuyProcess.Start)
+
+    keyboard = get_main_menu_keyboard()
+    await safe_send_message(bot, chat_id, "Вы можете снова выбрать действие.",
+                            reply_markup=keyboard, priority=PRIORITY_HIGH)
+
+async def enable_client_job(job, context):
+    bot = context['bot']
+    chat_id, server = job.payload['chat_id'], job.payload['server']
+    registry = get_registry()
+
+    # Продление выполняется на том узле, где клиент был создан
+    stored = await get_wg_client(chat_id, server)
+    node, client_id = (registry.get_node(server, stored[1]), stored[0]) if stored else (None, None)
+
+    if client_id is None or not await node.api.enable_client(client_id):
+        # Сохранённый ID мог устареть: ищем клиента по имени на узлах региона
+        node, client_id = await registry.find_client(server, chat_id)
+        if client_id is None:
+            # Клиента нет ни на одном узле — оформляем продление как новое подключение
+            await safe_send_message(bot, chat_id, "Не удалось включить клиента, будет создан новый.", priority=PRIORITY_HIGH)
+            logger.warning(f"Не удалось включить клиента с chat_id {chat_id}, создаём нового.")
+            if await enqueue_payment_job(chat_id, server, f"{job.key}:create", 'create', job.payload) is None:
+                raise JobRetry(f"Не удалось поставить задачу создания клиента {chat_id}")
+            job_runner.wake()
+            return
+
+        await set_wg_client_id(chat_id, server, client_id, node.name)
+        if not await node.api.enable_client(client_id):
+            raise JobRetry(f"Не удалось включить клиента {chat_id} на узле {node.name}")
+
+    await safe_send_message(bot, chat_id, "Ваша подписка продлена, клиент WireGuard был включён.", priority=PRIORITY_HIGH)
+    logger.info(f"Клиент с chat_id {chat_id} был повторно включён в WireGuard на узле {node.name}.")
+    # Необходимо обновить состояние пользователя
+    await get_user_context(bot, context['fsm_storage'], chat_id).set_state(BuyProcess.Start)
+    await edit_admin_caption(bot, job.payload, f"Подписка пользователя {chat_id} на сервер {server} продлена.")
+
+async def approval_failed(job, context, error):
+    bot = context['bot']
+    chat_id, server = job.payload['chat_id'], job.payload['server']
+    await safe_send_message(bot, chat_id, "Не удалось подключить WireGuard. Мы свяжемся с вами в ближайшее время.", priority=PRIORITY_HIGH)
+    # Кнопки возвращаются: повторное одобрение перезапускает ту же задачу без повторной записи оплаты
+    await edit_admin_caption(
+        bot, job.payload,
+        f"Платёж пользователя {chat_id} на сервер {server}: не удалось подключить клиента ({error}).",
+        reply_markup=get_approval_inline_keyboard(chat_id, server)
+    )
+
+job_runner.register('create', create_client_job, on_failure=approval_failed, lock=client_lock)
+job_runner.register('enable', enable_client_job, on_failure=approval_failed, lock=client_lock)
+
+async def handle_approval(query: types.CallbackQuery, fsm_storage: BaseStorage):
     parts = query.data.split('_')
     if len(parts) != 3:
         await query.answer("Неверный формат данных.")
@@ -26,97 +144,52 @@ async def handle_approval(query: types.CallbackQuery, state: FSMContext):
 
     action, chat_id, server = parts
 
-    server_ip = Config.WG1_SERVER_IP if server == 'Finland' else Config.WG2_SERVER_IP if server == 'USA' else None
-
-    if server_ip is None:
+    if get_registry().get_region(server) is None:
         await query.answer("Неизвестный сервер.")
         logger.warning(f"Неизвестный сервер в callback_query: {server}")
         return
 
-    wg_api = WgEasyAPI(base_url=server_ip, password=Config.WG_PASSWORD)
-
     if action == "approve":
-        user = get_user_by_chat_id(chat_id)
-        if user:
-            last_payment_date = get_last_payment_date(chat_id, server)
-            if last_payment_date:
-                days_passed = (datetime.now() - last_payment_date).days
-
-                if 30 <= days_passed <= 33:
-                    if wg_api.authenticate():
-                        clients = wg_api.get_clients()
-                        existing_client = next((client for client in clients if client['name'] == str(chat_id)), None)
-
-                        if existing_client:
-                            client_id = existing_client['id']
-
-                            enable_response = wg_api.enable_client(client_id)
-                            if enable_response:
-                                await safe_send_message(query.message.bot, chat_id,
-                                                        "Ваша подписка продлена, клиент WireGuard был включён.")
-                                logger.info(f"Клиент с chat_id {chat_id} был повторно включён в WireGuard.")
-                                # Необходимо обновить состояние пользователя
-                                await state.set_state(BuyProcess.Start)
-                                set_user_state(chat_id, BuyProcess.Start)
-                                return
-                            else:
-                                await safe_send_message(query.message.bot, chat_id,
-                                                        "Не удалось включить клиента, будет создан новый.")
-                                logger.warning(f"Не удалось включить клиента с chat_id {chat_id}, создаём нового.")
-
-        update_user_payment(chat_id, server)
-        if wg_api.authenticate():
-            creation_response = wg_api.create_client(chat_id)
-            logger.info(f"Ответ от WireGuard API при создании клиента: {creation_response}")
-
-            clients = wg_api.get_clients()
-            created_client = next((client for client in clients if client['name'] == str(chat_id)), None)
-
-            if created_client:
-                client_id = created_client['id']
-                client_config = wg_api.get_config_client(client_id)
-
-                if client_config:
-                    img = qrcode.make(client_config)
-                    qr_code_path = os.path.join(qr_code_dir, f"wg_qrcode_{chat_id}_{server}.png")
-
-                    img.save(qr_code_path)
-
-                    qr_code_input = FSInputFile(qr_code_path)
-                    await safe_send_photo(query.message.bot, chat_id, qr_code_input,
-                                         caption="Успешно! Вот ваш QR-код для подключения WireGuard.")
-
-                    await safe_send_message(query.message.bot, chat_id,
-                                            f"Вот ваша конфигурация WireGuard для сервера {server}:\n\n{client_config}")
-                    logger.info(f"Клиент с chat_id {chat_id} одобрен на сервере {server}, и QR-код с конфигурацией отправлены.")
-                else:
-                    await safe_send_message(query.message.bot, chat_id, "Ошибка при получении конфигурации.")
-                    logger.error(f"Ошибка при получении конфигурации для клиента {chat_id}")
-            else:
-                await safe_send_message(query.message.bot, chat_id, "Не удалось найти созданного клиента.")
-                logger.error(f"Клиент с chat_id {chat_id} не найден среди списка клиентов на сервере {server}.")
-
-            await query.message.edit_caption(caption=f"Платёж пользователя {chat_id} на сервер {server} был одобрен.")
-
-            await state.set_state(BuyProcess.Start)
-            set_user_state(chat_id, BuyProcess.Start)
-
-            keyboard = get_main_menu_keyboard()
-            await safe_send_message(query.message.bot, chat_id, "Вы можете снова выбрать действие.",
-                                    reply_markup=keyboard)
-
+        # Ключ задачи — сообщение с чеком: повторное одобрение того же чека не создаёт второе подключение
+        job_key = f"approve:{query.message.chat.id}:{query.message.message_id}"
+        payload = {
+            'chat_id': int(chat_id),
+            'server': server,
+            'admin_chat_id': query.message.chat.id,
+            'admin_message_id': query.message.message_id
+        }
+
+        # Отдельная проверка пользователя не нужна: без записи в users нет и оплат, а вставка оплаты проверяет его сама
+        last_payment_date = await get_last_payment_date(chat_id, server)
+        renewal = last_payment_date is not None and 30 <= (datetime.now() - last_payment_date).days <= 33
+
+        if renewal:
+            result = await enqueue_job(job_key, 'enable', payload)
         else:
-            await safe_send_message(query.message.bot, chat_id, "Не удалось аутентифицироваться в WireGuard API.")
-            logger.error(f"Не удалось аутентифицироваться в WireGuard API для сервера {server}")
+            # Оплата записывается вместе с задачей, клиент создаётся обработчиком очереди
+            result = await enqueue_payment_job(chat_id, server, job_key, 'create', payload)
+
+        # Оплата и задача фиксируются до ответа администратору и до пробуждения обработчиков очереди
+        if result is None or not await commit_unit_of_work():
+            await query.answer("Не удалось сохранить платёж, попробуйте ещё раз.")
+            return
+        if result == 0:
+            await query.answer("Этот платёж уже обработан или обрабатывается.")
+            return
+
+        await query.answer("Платёж принят в обработку.")
+        await query.message.edit_caption(caption=f"Платёж пользователя {chat_id} на сервер {server} обрабатывается...")
+        job_runner.wake()
 
     elif action == "reject":
+        await query.answer()
+        user_state = get_user_context(query.message.bot, fsm_storage, chat_id)
         await safe_send_message(query.message.bot, chat_id,
-                                "Ошибка. Ваши данные были отклонены. Если что-то не так, свяжитесь по почте lerk@joulerk.ru")
+                                "Ошибка. Ваши данные были отклонены. Если что-то не так, свяжитесь по почте lerk@joulerk.ru", priority=PRIORITY_HIGH)
         await query.message.edit_caption(caption=f"Платёж пользователя {chat_id} на сервер {server} был отклонён.")
         logger.info(f"Платёж пользователя {chat_id} на сервер {server} отклонён.")
 
-        await state.set_state(BuyProcess.Start)
-        set_user_state(chat_id, BuyProcess.Start)
+        await user_state.set_state(BuyProcess.Start)
 
         keyboard = get_main_menu_keyboard()
-        await safe_send_message(query.message.bot, chat_id, "Вы можете снова выбрать действие.", reply_markup=keyboard)
+        await safe_send_message(query.message.bot, chat_id, "Вы можете снова выбрать действие.", reply_markup=keyboard, priority=PRIORITY_HIGH)
@@ -0,0 +1,77 @@
+# provisioning.py
+import logging
+from datetime import datetime
+from cache import MISSING
+from db import get_db_connection, get_payment_date
+from db_async import run_db
+from jobs import JobRunner, JobRetry
+from servers import get_registry
+
+logger = logging.getLogger(__name__)
+
+# Общая очередь задач wg-easy; обработчики подключения регистрирует payments.py
+job_runner = JobRunner()
+
+# Дата оплаты в задачах отключения и удаления: задача относится только к этой подписке
+PAYMENT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def load_payment_date(user_id, server):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return MISSING
+        return get_payment_date(connection, user_id, server)
+
+async def payment_superseded(payload):
+    # Задача могла ждать повтора, пока пользователь снова оплатил подписку: тогда клиент wg-easy уже принадлежит новой оплате
+    if 'date_payed' not in payload:
+        return False
+    latest = await run_db(load_payment_date, payload['user_id'], payload['server'])
+    if latest is MISSING:
+        raise JobRetry(f"Не удалось проверить оплату пользователя {payload['user_id']}")
+    if latest is None:
+        return False
+    scheduled = payload['date_payed']
+    return scheduled is None or latest > datetime.strptime(scheduled, PAYMENT_DATE_FORMAT)
+
+def client_lock(job):
+    # Задачи одного пользователя на одном сервере меняют одного и того же клиента wg-easy
+    payload = job.payload
+    return f"client:{payload.get('user_id', payload.get('chat_id'))}:{payload['server']}"
+
+async def client_exists(node, chat_id):
+    # Отсутствие клиента подтверждает выполнение задачи, поэтому список запрашивается заново
+    snapshot = await node.api.get_snapshot(max_age=0)
+    if snapshot is None:
+        raise JobRetry(f"Не удалось получить список клиентов узла {node.name}")
+    return snapshot.find(chat_id) is not None
+
+async def disable_client_job(job, context):
+    payload = job.payload
+    if await payment_superseded(payload):
+        logger.info(f"Отключение клиента {payload['user_id']} на сервере {payload['server']} отменено: подписка оплачена заново")
+        return
+    node = get_registry().get_node(payload['server'], payload['node'])
+    if await node.api.disable_client(payload['user_id'], client_id=payload['wg_client_id']):
+        logger.info(f"Клиент {payload['user_id']} на сервере {payload['server']} отключён")
+        return
+    # Клиента уже нет на узле — отключать нечего
+    if await client_exists(node, payload['user_id']):
+        raise JobRetry(f"Не удалось отключить клиента {payload['user_id']} на узле {node.name}")
+
+async def remove_client_job(job, context):
+    payload = job.payload
+    if await payment_superseded(payload):
+        logger.info(f"Удаление клиента {payload['user_id']} на сервере {payload['server']} отменено: подписка оплачена заново")
+        return
+    registry = get_registry()
+    node = registry.get_node(payload['server'], payload['node'])
+    if await node.api.remove_client(payload['user_id'], client_id=payload['wg_client_id']):
+        registry.client_removed(node)
+        return
+    # Ответ на удаление мог потеряться при предыдущей попытке; отсутствие клиента означает, что задача выполнена
+    if await client_exists(node, payload['user_id']):
+        raise JobRetry(f"Не удалось удалить клиента {payload['user_id']} на узле {node.name}")
+
+job_runner.register('disable', disable_client_job, lock=client_lock)
+job_runner.register('remove', remove_client_job, lock=client_lock)
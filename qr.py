@@ -0,0 +1,38 @@
+# qr.py
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+from config import Config
+
+_executor = None
+
+def render_qr_png(data):
+    # Выполняется в дочернем процессе: кодирование PNG нагружает CPU и не должно занимать цикл событий
+    buffer = io.BytesIO()
+    qrcode.make(data).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn вместо fork: к этому моменту в процессе уже работают потоки пула базы данных
+        _executor = ProcessPoolExecutor(max_workers=Config.QR_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+async def render_qr(data):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), render_qr_png, data)
+
+async def start_qr_pool():
+    # Процессы, запущенные через spawn, заново импортируют главный модуль; это дорого, поэтому делаем это до приёма обновлений
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, render_qr_png, 'warmup') for _ in range(Config.QR_WORKERS)))
+
+def shutdown_qr_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,196 @@
+# reconcile.py
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from datetime import datetime
+from db import get_db_connection, close_db_pool, get_server_clients, set_wg_client_ids, enqueue_jobs
+from db_async import run_db, shutdown_db_executor
+from locks import AdvisoryLock, MAINTENANCE_LOCK
+from wg import close_wg_apis
+from servers import get_registry
+from provisioning import job_runner
+from expiry import WARN_DAYS
+from config import Config
+from aiogram import Bot
+from notifier import notifier
+from logger import logger
+
+class Drift:
+    def __init__(self, server):
+        self.server = server
+        # Включённые клиенты wg-easy без записи в clients: (узел, Peer)
+        self.orphans = []
+        # Активные подписки без клиента ни на одном узле региона
+        self.missing = []
+        # Записи, у которых сохранённые ID или узел не совпадают с найденным клиентом: (user_id, client_id, узел)
+        self.stale_ids = []
+        # Узлы, список клиентов которых получить не удалось
+        self.unavailable = []
+        self.peers = 0
+        self.rows = 0
+
+    def summary(self):
+        return (
+            f"Сервер {self.server}: клиентов wg-easy {self.peers}, записей в базе {self.rows}, "
+            f"лишних {len(self.orphans)}, отсутствующих {len(self.missing)}, устаревших ID {len(self.stale_ids)}"
+            + (f", недоступные узлы: {', '.join(self.unavailable)}" if self.unavailable else "")
+        )
+
+def load_server_clients(server):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return None
+        return get_server_clients(connection, server)
+
+async def list_peers(region):
+    # Сверка всегда идёт по свежим спискам, а не по сохранённым в процессе
+    listings = await asyncio.gather(*(node.api.get_snapshot(max_age=0) for node in region.nodes))
+    return list(zip(region.nodes, listings))
+
+def diff_region(region, listings, rows):
+    drift = Drift(region.name)
+    drift.rows = len(rows)
+
+    # Имя клиента wg-easy — chat_id пользователя; остальные клиенты созданы не ботом и не сверяются
+    peers = {}
+    for node, snapshot in listings:
+        if snapshot is None:
+            drift.unavailable.append(node.name)
+            continue
+        drift.peers += len(snapshot)
+        for peer in snapshot:
+            if peer.name.isdigit():
+                peers.setdefault(int(peer.name), (node, peer))
+
+    subscriptions = {row['user_id']: row for row in rows}
+
+    for user_id in peers.keys() - subscriptions.keys():
+        node, peer = peers[user_id]
+        if peer.enabled:
+            drift.orphans.append((node, peer))
+
+    for user_id in subscriptions.keys() & peers.keys():
+        row = subscriptions[user_id]
+        node, peer = peers[user_id]
+        if row['wg_client_id'] != peer.id or row['node'] != node.name:
+            drift.stale_ids.append((user_id, peer.id, node.name))
+
+    # Отсутствие клиента можно утверждать, только если ответили все узлы региона.
+    # Подписки в периоде предупреждения не восстанавливаются: клиента скоро удалит планировщик
+    if not drift.unavailable:
+        drift.missing = [
+            subscriptions[user_id]
+            for user_id in subscriptions.keys() - peers.keys()
+            if subscriptions[user_id]['days_passed'] < WARN_DAYS[0]
+        ]
+    return drift
+
+def apply_drift(drift, run_id):
+    with get_db_connection() as connection:
+        if connection is None:
+            logger.error("Не удалось подключиться к базе данных")
+            return None
+
+        updated = set_wg_client_ids(connection, drift.server, drift.stale_ids)
+        if updated is None:
+            return None
+
+        jobs = [
+            (f"reconcile:{run_id}:disable:{node.name}:{peer.id}", 'disable', {
+                'user_id': int(peer.name),
+                'server': drift.server,
+                'node': node.name,
+                'wg_client_id': peer.id,
+                # Подписки не было: задача отменяется, если до её выполнения пользователь оплатит
+                'date_payed': None
+            })
+            for node, peer in drift.orphans
+        ]
+        # Новый клиент создаётся задачей подключения в боте: пользователь получит новую конфигурацию и QR-код.
+        # Ключ привязан к оплате, а не к запуску: пока бот не выполнил задачу, следующая сверка не создаст вторую
+        jobs += [
+            (f"reconcile:create:{row['user_id']}:{drift.server}:{row['date_payed']:%Y%m%d%H%M%S}", 'create', {
+                'chat_id': row['user_id'],
+                'server': drift.server
+            })
+            for row in drift.missing
+        ]
+        created = enqueue_jobs(connection, jobs)
+        if created is None:
+            return None
+        return updated, created
+
+def print_report(drift, show):
+    print(drift.summary())
+    for title, items in (
+        ("лишний клиент wg-easy, будет отключён", [f"{peer.name} ({node.name}, {peer.id})" for node, peer in drift.orphans]),
+        ("нет клиента wg-easy, будет создан", [f"{row['user_id']} (оплата {row['date_payed']:%Y-%m-%d})" for row in drift.missing]),
+        ("устаревший ID клиента", [f"{user_id} -> {client_id} ({node})" for user_id, client_id, node in drift.stale_ids]),
+    ):
+        for item in items[:show]:
+            print(f"  {title}: {item}")
+        if len(items) > show:
+            print(f"  ... и ещё {len(items) - show}")
+
+async def reconcile_region(region, args, run_id):
+    started = time.perf_counter()
+    rows, listings = await asyncio.gather(run_db(load_server_clients, region.name), list_peers(region))
+    if rows is None:
+        logger.error(f"Сервер {region.name} пропущен: не удалось загрузить клиентов из базы")
+        return None
+
+    drift = diff_region(region, listings, rows)
+    print_report(drift, args.show)
+    if args.dry_run:
+        return drift
+
+    applied = await run_db(apply_drift, drift, run_id)
+    if applied is None:
+        logger.error(f"Не удалось применить исправления для сервера {region.name}")
+        return None
+    updated, created = applied
+    logger.info(f"Сервер {region.name}: обновлено ID {updated}, создано задач {created}, за {time.perf_counter() - started:.2f} с")
+    return drift
+
+async def main(args):
+    registry = get_registry()
+    regions = [registry.get_region(args.server)] if args.server else list(registry.regions.values())
+    if None in regions:
+        print(f"Неизвестный сервер: {args.server}", file=sys.stderr)
+        return 2
+
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    bot = Bot(token=Config.TELEGRAM_BOT_TOKEN)
+    lock = AdvisoryLock(MAINTENANCE_LOCK)
+    try:
+        # Просмотр расхождений ничего не меняет; исправления не применяются одновременно с check_clients.py
+        if not args.dry_run and not await lock.acquire():
+            print("Проверка или сверка клиентов уже выполняется в другом процессе", file=sys.stderr)
+            return 1
+        drifts = await asyncio.gather(*(reconcile_region(region, args, run_id) for region in regions))
+        if not args.dry_run:
+            # Отключение выполняется здесь же; создание клиентов и отправку конфигураций выполнит бот
+            await job_runner.drain(kinds=('disable',), limit=Config.CHECK_WG_CONCURRENCY, bot=bot)
+            logger.info(f"Задачи wg-easy: {job_runner.stats()}")
+        return 1 if None in drifts else 0
+    finally:
+        await lock.release()
+        await notifier.close()
+        await bot.session.close()
+        await close_wg_apis()
+        shutdown_db_executor()
+        close_db_pool()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Сверка клиентов wg-easy с таблицей clients")
+    parser.add_argument('--dry-run', action='store_true', help="только показать расхождения, ничего не меняя")
+    parser.add_argument('--server', default=None, help="сверить только указанный регион")
+    parser.add_argument('--show', type=int, default=20, help="сколько примеров каждого расхождения выводить")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    sys.exit(asyncio.run(main(parse_args(sys.argv[1:]))))
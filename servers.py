@@ -0,0 +1,154 @@
+# servers.py
+import asyncio
+import json
+import logging
+import time
+from config import Config
+from wg import get_wg_api
+
+logger = logging.getLogger(__name__)
+
+class Node:
+    __slots__ = ('name', 'region', 'url', 'password', 'client_count', 'counted_at', 'lock')
+
+    def __init__(self, name, region, url, password=None):
+        self.name = name
+        self.region = region
+        self.url = url
+        self.password = password or Config.WG_PASSWORD
+        # Число клиентов узла по последнему списку wg-easy; None — узел ещё не опрашивался или недоступен
+        self.client_count = None
+        self.counted_at = 0.0
+        self.lock = asyncio.Lock()
+
+    @property
+    def api(self):
+        return get_wg_api(self.url, self.password)
+
+class Region:
+    __slots__ = ('name', 'title', 'nodes')
+
+    def __init__(self, name, title, nodes):
+        self.name = name
+        self.title = title
+        self.nodes = nodes
+
+    @property
+    def button_text(self):
+        return f"Купить '{self.title}'"
+
+class ServerRegistry:
+    def __init__(self, regions, count_ttl=None):
+        self.regions = {region.name: region for region in regions}
+        self.count_ttl = count_ttl if count_ttl is not None else Config.WG_NODE_COUNT_TTL
+        self._by_button = {region.button_text: region for region in regions}
+        self._nodes = {node.name: node for region in regions for node in region.nodes}
+
+    @property
+    def nodes(self):
+        return list(self._nodes.values())
+
+    def get_region(self, name):
+        return self.regions.get(name)
+
+    def region_by_button(self, text):
+        return self._by_button.get(text)
+
+    def get_node(self, region_name, node_name=None):
+        # Клиенты, созданные до появления реестра, не имеют узла и живут на первом узле региона
+        region = self.regions.get(region_name)
+        if region is None:
+            return None
+        node = self._nodes.get(node_name) if node_name else None
+        if node is None or node.region != region_name:
+            return region.nodes[0]
+        return node
+
+    async def _refresh_count(self, node):
+        async with node.lock:
+            if node.client_count is not None and time.monotonic() - node.counted_at < self.count_ttl:
+                return
+            snapshot = await node.api.get_snapshot(max_age=self.count_ttl)
+            # Недоступный узел не участвует в выборе, пока не ответит снова
+            node.client_count = len(snapshot) if snapshot is not None else None
+            node.counted_at = time.monotonic()
+
+    async def pick_node(self, region_name):
+        region = self.regions.get(region_name)
+        if region is None:
+            return None
+        if len(region.nodes) == 1:
+            return region.nodes[0]
+
+        await asyncio.gather(*(self._refresh_count(node) for node in region.nodes))
+        available = [node for node in region.nodes if node.client_count is not None]
+        if not available:
+            logger.warning(f"Нет данных о загрузке узлов региона {region_name}, используется узел {region.nodes[0].name}")
+            return region.nodes[0]
+
+        node = min(available, key=lambda n: n.client_count)
+        # Счётчик увеличивается сразу, чтобы одновременные подключения распределялись по узлам до следующего опроса
+        node.client_count += 1
+        return node
+
+    def client_removed(self, node):
+        if node.client_count:
+            node.client_count -= 1
+
+    async def find_client(self, region_name, chat_id, refresh=True):
+        region = self.regions.get(region_name)
+        if region is None:
+            return None, None
+        for node in region.nodes:
+            peer = await node.api.find_client(chat_id, refresh=refresh)
+            if peer is not None:
+                return node, peer.id
+        return None, None
+
+def parse_servers(raw):
+    regions = []
+    for region_config in json.loads(raw):
+        name = region_config['region']
+        # Имя региона входит в callback_data вида approve_<chat_id>_<регион>
+        if '_' in name:
+            raise ValueError(f"Имя региона {name} не должно содержать символ '_'")
+        nodes = [
+            Node(node['name'], name, node['url'], node.get('password'))
+            for node in region_config['nodes']
+        ]
+        if not nodes:
+            raise ValueError(f"Для региона {name} не задано ни одного узла")
+        regions.append(Region(name, region_config.get('title', name), nodes))
+    return regions
+
+def load_registry():
+    if Config.WG_SERVERS:
+        regions = parse_servers(Config.WG_SERVERS)
+    else:
+        # Прежняя конфигурация: по одному узлу на регион, имя узла совпадает с именем региона
+        regions = [
+            Region(name, title, [Node(name, name, url)])
+            for name, title, url in (
+                ('Finland', 'Финляндия', Config.WG1_SERVER_IP),
+                ('USA', 'США', Config.WG2_SERVER_IP),
+            )
+            if url
+        ]
+
+    names = [node.name for region in regions for node in region.nodes]
+    if len(names) != len(set(names)):
+        raise ValueError("Имена узлов WireGuard должны быть уникальными")
+    return ServerRegistry(regions)
+
+_registry = None
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = load_registry()
+        logger.info(f"Загружено регионов: {len(_registry.regions)}, узлов: {len(_registry.nodes)}")
+    return _registry
+
+def reset_registry():
+    global _registry
+    _registry = None
@@ -0,0 +1,194 @@
+# storage.py
+import asyncio
+import logging
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from config import Config
+from db import load_user_state, save_user_states, save_user_state, save_user_data
+from db_async import run_db_outside_unit
+
+logger = logging.getLogger(__name__)
+
+class _Record:
+    __slots__ = ('state', 'data', 'dirty')
+
+    def __init__(self, state=None, data=None):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.dirty = False
+
+class MySQLStorage(BaseStorage):
+    # Состояние и данные FSM хранятся в user_states; изменения копятся в памяти и пишутся в базу порциями
+    # shared=True — несколько процессов бота: следующее обновление пользователя может обработать другой процесс,
+    # поэтому состояние не кэшируется, а каждое изменение сразу записывается в базу.
+    # Запросы хранилища не входят в единицу работы обработчика: иначе чтение состояния держало бы её соединение
+    # до конца обработчика, в том числе во время отправки сообщений
+    def __init__(self, flush_interval=None, batch_size=None, cache_size=None, shared=None):
+        self.flush_interval = flush_interval if flush_interval is not None else Config.FSM_FLUSH_INTERVAL
+        self.batch_size = batch_size if batch_size is not None else Config.FSM_FLUSH_BATCH_SIZE
+        self.cache_size = cache_size if cache_size is not None else Config.FSM_CACHE_SIZE
+        self.shared = shared if shared is not None else Config.MULTI_REPLICA
+
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._loading = {}
+        self._flush_task = None
+        self._flush_requested = None
+        self._closed = False
+
+    @staticmethod
+    def _user_id(key):
+        # Бот работает только в личных чатах, поэтому chat_id совпадает с user_id пользователя
+        return key.chat_id
+
+    async def _get_record(self, key):
+        user_id = self._user_id(key)
+        record = self._records.get(user_id)
+        if record is not None:
+            self._records.move_to_end(user_id)
+            return record
+
+        # Параллельные обращения к одному ключу ждут одной и той же загрузки
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(run_db_outside_unit(load_user_state, user_id))
+            self._loading[user_id] = loading
+            try:
+                loaded = await loading
+            finally:
+                self._loading.pop(user_id, None)
+            if loaded is None:
+                # Пустая запись не кэшируется, и следующее обращение снова попробует загрузить состояние из базы
+                return _Record()
+            state, data = loaded
+            record = self._records.get(user_id)
+            if record is None:
+                self._evict()
+                record = _Record(state, data)
+                self._records[user_id] = record
+            return record
+
+        await loading
+        return await self._get_record(key)
+
+    def _write_through(self, key, record):
+        # Изменение пишется сразу и только в своё поле, если состояние не загрузилось из базы (чтобы не затереть сохранённое)
+        # или хранилище уже закрыто: aiogram закрывает его раньше, чем останавливаются задачи, которые ещё меняют состояния
+        return self._closed or self._records.get(self._user_id(key)) is not record
+
+    def _evict(self):
+        # Вытесняются только записи, уже сохранённые в базе
+        while len(self._records) >= self.cache_size:
+            for user_id, record in self._records.items():
+                if not record.dirty:
+                    del self._records[user_id]
+                    break
+            else:
+                return
+
+    def _mark_dirty(self, user_id, record):
+        record.dirty = True
+        self._dirty.add(user_id)
+        self._ensure_flusher()
+        if len(self._dirty) >= self.batch_size:
+            self._flush_requested.set()
+
+    def _ensure_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_requested = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        user_ids = list(self._dirty)
+        self._dirty.clear()
+        rows = [(user_id, self._records[user_id].state, dict(self._records[user_id].data)) for user_id in user_ids]
+
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            saved = await run_db_outside_unit(save_user_states, batch)
+            for user_id, _, _ in batch:
+                if not saved:
+                    # Не удалось записать: ключ остаётся грязным и попадёт в следующую порцию
+                    self._dirty.add(user_id)
+                elif user_id not in self._dirty:
+                    # Запись могла измениться, пока шло сохранение; тогда она остаётся грязной
+                    self._records[user_id].dirty = False
+
+    async def _load_shared(self, key):
+        user_id = self._user_id(key)
+        loaded = await run_db_outside_unit(load_user_state, user_id)
+        if loaded is None:
+            return None, {}
+        return loaded
+
+    async def _save_shared(self, func, key, value):
+        # Состояние и данные пишутся отдельными запросами: одновременные изменения из разных процессов не затирают друг друга
+        user_id = self._user_id(key)
+        if not await run_db_outside_unit(func, user_id, value):
+            raise RuntimeError(f"Не удалось сохранить состояние пользователя {user_id}")
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        if self.shared:
+            await self._save_shared(save_user_state, key, state)
+            return
+        record = await self._get_record(key)
+        if self._write_through(key, record):
+            record.state = state
+            await self._save_shared(save_user_state, key, state)
+            return
+        record.state = state
+        self._mark_dirty(self._user_id(key), record)
+
+    async def get_state(self, key):
+        if self.shared:
+            state, _ = await self._load_shared(key)
+            return state
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        if self.shared:
+            await self._save_shared(save_user_data, key, data.copy())
+            return
+        record = await self._get_record(key)
+        if self._write_through(key, record):
+            record.data = data.copy()
+            await self._save_shared(save_user_data, key, data.copy())
+            return
+        record.data = data.copy()
+        self._mark_dirty(self._user_id(key), record)
+
+    async def get_data(self, key):
+        if self.shared:
+            _, data = await self._load_shared(key)
+            return data
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    def stats(self):
+        return {'cached': len(self._records), 'dirty': len(self._dirty)}
+
+    async def close(self):
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_requested.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        if self._dirty:
+            logger.error(f"Не удалось сохранить состояния {len(self._dirty)} пользователей при остановке")
+        logger.info("Хранилище состояний FSM закрыто")
@@ -1,25 +1,30 @@
 from aiogram.exceptions import TelegramAPIError
 import logging
+from notifier import notifier, PRIORITY_NORMAL
 
 logger = logging.getLogger(__name__)
 
-async def safe_send_message(bot, chat_id, text, **kwargs):
+async def safe_send_message(bot, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
     try:
-        await bot.send_message(chat_id, text, **kwargs)
-        logger.info(f"Сообщение отправлено пользователю {chat_id}: {text}")
+        result = await notifier.submit(bot.send_message, chat_id, text, priority=priority, **kwargs)
+        # Текст не пишется в журнал: в нём бывает конфигурация WireGuard с приватным ключом
+        logger.info(f"Сообщение отправлено пользователю {chat_id} ({len(text)} символов)", extra={'sample': 'send'})
+        return result
     except TelegramAPIError as e:
         logger.error(f"Ошибка при отправке сообщения пользователю {chat_id}: {e}")
 
-async def safe_send_photo(bot, chat_id, photo, caption=None, **kwargs):
+async def safe_send_photo(bot, chat_id, photo, caption=None, priority=PRIORITY_NORMAL, **kwargs):
     try:
-        await bot.send_photo(chat_id, photo, caption=caption, **kwargs)
-        logger.info(f"Фото отправлено пользователю {chat_id}")
+        result = await notifier.submit(bot.send_photo, chat_id, photo, caption=caption, priority=priority, **kwargs)
+        logger.info(f"Фото отправлено пользователю {chat_id}", extra={'sample': 'send'})
+        return result
     except TelegramAPIError as e:
         logger.error(f"Ошибка при отправке фото пользователю {chat_id}: {e}")
 
-async def safe_send_document(bot, chat_id, document, caption=None, **kwargs):
+async def safe_send_document(bot, chat_id, document, caption=None, priority=PRIORITY_NORMAL, **kwargs):
     try:
-        await bot.send_document(chat_id, document, caption=caption, **kwargs)
-        logger.info(f"Документ отправлен пользователю {chat_id}")
+        result = await notifier.submit(bot.send_document, chat_id, document, caption=caption, priority=priority, **kwargs)
+        logger.info(f"Документ отправлен пользователю {chat_id}", extra={'sample': 'send'})
+        return result
     except TelegramAPIError as e:
         logger.error(f"Ошибка при отправке документа пользователю {chat_id}: {e}")
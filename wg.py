@@ -1,155 +1,355 @@
-import requests
+import asyncio
+import itertools
+import aiohttp
 import logging
+import re
+import sys
+import time
 from config import Config
+from metrics import WG_REQUESTS, WG_SECONDS, WG_ERRORS
 
 logger = logging.getLogger(__name__)
 
+_NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# ID клиента убирается из пути, чтобы число серий метрик не росло вместе с числом клиентов
+_CLIENT_ID_RE = re.compile(r'/client/[^/]+')
+
+def _endpoint(path):
+    return _CLIENT_ID_RE.sub('/client/{id}', path)
+
+class Peer:
+    # Из ответа wg-easy хранится только то, что нужно боту: ключи, адреса и даты отбрасываются сразу после разбора
+    __slots__ = ('id', 'name', 'enabled')
+
+    def __init__(self, id, name, enabled):
+        self.id = id
+        self.name = name
+        self.enabled = enabled
+
+class PeerSnapshot:
+    # Список клиентов узла с поиском по имени (chat_id) и по ID за O(1)
+    __slots__ = ('by_id', 'by_name', 'fetched_at', 'size_bytes')
+
+    def __init__(self, clients, fetched_at):
+        self.by_id = {}
+        self.by_name = {}
+        for client in clients:
+            peer = Peer(client['id'], client['name'], client['enabled'])
+            self.by_id[peer.id] = peer
+            # При одинаковых именах находится первый клиент, как и при переборе списка
+            self.by_name.setdefault(peer.name, peer)
+        self.fetched_at = fetched_at
+        # Оценка занимаемой памяти: объекты клиентов, их строки и оба индекса
+        self.size_bytes = sys.getsizeof(self.by_id) + sys.getsizeof(self.by_name) + sum(
+            sys.getsizeof(peer) + sys.getsizeof(peer.id) + sys.getsizeof(peer.name) for peer in self.by_id.values()
+        )
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def find(self, name):
+        return self.by_name.get(str(name))
+
+    def get(self, client_id):
+        return self.by_id.get(client_id)
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    def discard(self, client_id):
+        peer = self.by_id.pop(client_id, None)
+        if peer is not None and self.by_name.get(peer.name) is peer:
+            del self.by_name[peer.name]
+
+    def set_enabled(self, client_id, enabled):
+        peer = self.by_id.get(client_id)
+        if peer is not None:
+            peer.enabled = enabled
+
 class WgEasyAPI:
-    def __init__(self, base_url, password):
+    def __init__(self, base_url, password, connect_timeout=None, read_timeout=None):
         self.base_url = base_url
         self.headers = {'Content-Type': 'application/json'}
         self.password = password
-        self.session_cookies = None
+        self.timeout = aiohttp.ClientTimeout(
+            connect=connect_timeout if connect_timeout is not None else Config.WG_CONNECT_TIMEOUT,
+            sock_read=read_timeout if read_timeout is not None else Config.WG_READ_TIMEOUT
+        )
+        self._session = None
+        self._authenticated = False
+        self._auth_generation = 0
+        self._auth_lock = asyncio.Lock()
+        self._snapshot = None
+        self._snapshot_lock = asyncio.Lock()
+        self._invalidated_at = 0.0
         logger.info(f"Инициализация API с базовым URL: {self.base_url}")
 
-    def authenticate(self):
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # unsafe=True: wg-easy обычно доступен по IP, а стандартный CookieJar не хранит cookie для IP-адресов
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=Config.WG_POOL_LIMIT, keepalive_timeout=Config.WG_KEEPALIVE_TIMEOUT),
+                cookie_jar=aiohttp.CookieJar(unsafe=True)
+            )
+            self._authenticated = False
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._authenticated = False
+
+    def _observe(self, method, endpoint, started, failed):
+        labels = {'server': self.base_url, 'method': method, 'endpoint': endpoint}
+        WG_REQUESTS.inc(**labels)
+        WG_SECONDS.observe(time.perf_counter() - started, **labels)
+        if failed:
+            WG_ERRORS.inc(**labels)
+
+    async def authenticate(self):
         url = f"{self.base_url}/api/session"
         body = {"password": self.password}
         logger.info("Попытка аутентификации...")
 
+        started = time.perf_counter()
         try:
-            response = requests.post(url, headers=self.headers, json=body)
-            response.raise_for_status()
-            self.session_cookies = response.cookies
+            async with self._get_session().post(url, json=body) as response:
+                response.raise_for_status()
+            self._observe('POST', '/api/session', started, failed=False)
+            self._authenticated = True
+            self._auth_generation += 1
             logger.info("Аутентификация успешна")
             return True
-        except requests.exceptions.RequestException as e:
+        except _NETWORK_ERRORS as e:
+            self._observe('POST', '/api/session', started, failed=True)
+            self._authenticated = False
             logger.error(f"Ошибка аутентификации: {e}")
             return False
 
-    def create_client(self, chat_id):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед созданием клиента")
-            return None
+    async def ensure_authenticated(self):
+        if self._authenticated:
+            return True
+        async with self._auth_lock:
+            if self._authenticated:
+                return True
+            return await self.authenticate()
+
+    async def _reauthenticate(self, generation):
+        async with self._auth_lock:
+            # Другая корутина могла уже обновить сессию, пока мы ждали блокировку
+            if self._authenticated and self._auth_generation != generation:
+                return True
+            return await self.authenticate()
+
+    async def _request(self, method, path, json=None, result=None):
+        if not await self.ensure_authenticated():
+            raise aiohttp.ClientError("Не удалось аутентифицироваться в WireGuard API")
+
+        url = f"{self.base_url}{path}"
+        endpoint = _endpoint(path)
+        for attempt in range(2):
+            generation = self._auth_generation
+            started = time.perf_counter()
+            try:
+                async with self._get_session().request(method, url, json=json) as response:
+                    expired = response.status == 401 and attempt == 0
+                    body = None
+                    if not expired:
+                        response.raise_for_status()
+                        if result == 'json':
+                            body = await response.json(content_type=None)
+                        elif result == 'text':
+                            body = await response.text()
+            except _NETWORK_ERRORS:
+                self._observe(method, endpoint, started, failed=True)
+                raise
+            self._observe(method, endpoint, started, failed=expired)
+
+            if expired:
+                logger.info("Сессия WireGuard API истекла, выполняется повторная аутентификация")
+                if not await self._reauthenticate(generation):
+                    raise aiohttp.ClientError("Не удалось повторно аутентифицироваться в WireGuard API")
+                continue
+            return body
+
+    async def get_snapshot(self, max_age=None):
+        # Список клиентов запрашивается не чаще раза в max_age секунд; одновременные вызовы ждут один запрос
+        max_age = Config.WG_SNAPSHOT_TTL if max_age is None else max_age
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.age() < max_age:
+            return snapshot
+
+        requested = time.monotonic()
+        async with self._snapshot_lock:
+            snapshot = self._snapshot
+            # Список, запрошенный после нашего вызова, уже достаточно свежий
+            if snapshot is not None and (snapshot.fetched_at >= requested or snapshot.age() < max_age):
+                return snapshot
+
+            fetched_at = time.monotonic()
+            clients = await self.get_clients()
+            if clients is None:
+                return None
+            snapshot = PeerSnapshot(clients, fetched_at)
+            # Список, запрошенный до создания клиента этим процессом, не кэшируется
+            if fetched_at >= self._invalidated_at:
+                self._snapshot = snapshot
+            logger.info(f"Список клиентов {self.base_url}: {len(snapshot)}, около {snapshot.size_bytes // 1024} КБ в памяти")
+            return snapshot
 
-        url = f"{self.base_url}/api/wireguard/client"
+    def invalidate_snapshot(self):
+        self._snapshot = None
+        self._invalidated_at = time.monotonic()
+
+    def snapshot_stats(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {'peers': 0, 'bytes': 0, 'age': None}
+        return {'peers': len(snapshot), 'bytes': snapshot.size_bytes, 'age': snapshot.age()}
+
+    async def create_client(self, chat_id):
         body = {"name": str(chat_id)}
         logger.info(f"Попытка создать клиента с chat_id: {chat_id}")
 
         try:
-            response = requests.post(url, headers=self.headers, json=body, cookies=self.session_cookies)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return await self._request('POST', "/api/wireguard/client", json=body, result='json')
+        except _NETWORK_ERRORS as e:
             logger.error(f"Ошибка при создании клиента: {e}")
             return None
+        finally:
+            # wg-easy не возвращает ID нового клиента: его найдёт следующий запрос списка
+            self.invalidate_snapshot()
 
-    def enable_client(self, client_id):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед включением клиента")
-            return False
-
-        url = f"{self.base_url}/api/wireguard/client/{client_id}/enable"
+    async def enable_client(self, client_id):
         logger.info(f"Попытка включить клиента с ID: {client_id}")
 
         try:
-            response = requests.post(url, headers=self.headers, cookies=self.session_cookies)
-            response.raise_for_status()
+            await self._request('POST', f"/api/wireguard/client/{client_id}/enable")
+            if self._snapshot is not None:
+                self._snapshot.set_enabled(client_id, True)
             logger.info(f"Клиент {client_id} успешно включён")
             return True
-        except requests.exceptions.RequestException as e:
+        except _NETWORK_ERRORS as e:
             logger.error(f"Ошибка при включении клиента {client_id}: {e}")
             return False
 
-    def disable_client(self, chat_id):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед отключением клиента")
-            return False
+    async def find_client(self, chat_id, refresh=True):
+        # refresh=False — вызывающий ожидает, что клиента нет, и промах по сохранённому списку не перепроверяется
+        started = time.monotonic()
+        snapshot = await self.get_snapshot()
+        if snapshot is None:
+            return None
+        peer = snapshot.find(chat_id)
+        if peer is None and refresh and snapshot.fetched_at < started:
+            # Клиента могли создать после получения списка (другой процесс или администратор): проверяем по свежему списку
+            snapshot = await self.get_snapshot(max_age=0)
+            peer = snapshot.find(chat_id) if snapshot is not None else None
+        return peer
 
-        clients = self.get_clients()
-        if not clients:
-            return False
+    async def find_client_id(self, chat_id):
+        peer = await self.find_client(chat_id)
+        if peer is None:
+            logger.info(f"Клиент с chat_id {chat_id} не найден среди существующих клиентов WireGuard")
+            return None
+        return peer.id
 
-        client = next((c for c in clients if c['name'] == str(chat_id)), None)
-        if not client:
-            logger.error(f"Клиент с chat_id {chat_id} не найден")
-            return False
+    async def _client_request(self, method, chat_id, client_id, suffix=''):
+        # Сохранённый ID используется напрямую; список клиентов запрашивается, только если ID неизвестен или устарел
+        if client_id is not None:
+            try:
+                await self._request(method, f"/api/wireguard/client/{client_id}{suffix}")
+                return client_id
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise
+                logger.warning(f"Клиент с ID {client_id} не найден, выполняется поиск по chat_id {chat_id}")
+                # Сохранённый список тоже мог содержать удалённого клиента
+                self.invalidate_snapshot()
 
-        client_id = client['id']
-        url = f"{self.base_url}/api/wireguard/client/{client_id}/disable"
+        client_id = await self.find_client_id(chat_id)
+        if client_id is None:
+            return None
+        await self._request(method, f"/api/wireguard/client/{client_id}{suffix}")
+        return client_id
 
+    async def disable_client(self, chat_id, client_id=None):
         try:
-            response = requests.post(url, headers=self.headers, cookies=self.session_cookies)
-            response.raise_for_status()
-            logger.info(f"Клиент {chat_id} успешно отключён")
-            return True
-        except requests.exceptions.RequestException as e:
+            client_id = await self._client_request('POST', chat_id, client_id, '/disable')
+        except _NETWORK_ERRORS as e:
             logger.error(f"Ошибка при отключении клиента {chat_id}: {e}")
             return False
 
-    def get_config_client(self, client_id):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед получением конфигурации клиента")
-            return None
+        if client_id is None:
+            return False
+        if self._snapshot is not None:
+            self._snapshot.set_enabled(client_id, False)
+        logger.info(f"Клиент {chat_id} успешно отключён")
+        return True
 
-        url = f"{self.base_url}/api/wireguard/client/{client_id}/configuration"
+    async def get_config_client(self, client_id):
         logger.info(f"Попытка получить конфигурацию клиента с ID: {client_id}")
 
         try:
-            response = requests.get(url, headers=self.headers, cookies=self.session_cookies)
-            response.raise_for_status()
-            config_data = response.text
-            return config_data
-        except requests.exceptions.RequestException as e:
+            return await self._request('GET', f"/api/wireguard/client/{client_id}/configuration", result='text')
+        except _NETWORK_ERRORS as e:
             logger.error(f"Ошибка при получении конфигурации клиента: {e}")
             return None
 
-    def get_clients(self):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед получением списка клиентов")
-            return None
-
-        url = f"{self.base_url}/api/wireguard/client"
+    async def get_clients(self):
         logger.info("Попытка получить список клиентов...")
 
         try:
-            response = requests.get(url, headers=self.headers, cookies=self.session_cookies)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
+            clients = await self._request('GET', "/api/wireguard/client", result='json')
+        except _NETWORK_ERRORS as e:
             logger.error(f"Ошибка при получении списка клиентов: {e}")
             return None
 
-        clients = response.json()
         logger.info(f"Всего клиентов: {len(clients)}")
 
-        for client in clients:
-            logger.info(f"Клиент: {client['name']}, IP: {client['address']}, ID: {client['id']}, Создан: {client['createdAt']}")
+        # По каждому клиенту пишется не больше LOG_SAMPLE_BURST строк за вызов, а между вызовами их дополнительно ограничивает выборка
+        if logger.isEnabledFor(logging.INFO):
+            for client in itertools.islice(clients, Config.LOG_SAMPLE_BURST):
+                logger.info("Клиент: %s, IP: %s, ID: %s, Создан: %s", client['name'], client['address'], client['id'], client['createdAt'],
+                            extra={'sample': 'wg.clients'})
         return clients
 
-    def remove_client(self, chat_id):
-        if not self.session_cookies:
-            logger.error("Необходимо выполнить аутентификацию перед удалением клиента")
-            return False
+    async def remove_client(self, chat_id, client_id=None):
+        logger.info(f"Попытка удалить клиента с ID: {client_id} и chat_id: {chat_id}")
 
-        clients = self.get_clients()
-        if not clients:
+        try:
+            client_id = await self._client_request('DELETE', chat_id, client_id)
+        except _NETWORK_ERRORS as e:
+            logger.error(f"Ошибка при удалении клиента {chat_id} из WireGuard: {e}")
             return False
 
-        client = next((c for c in clients if c['name'] == str(chat_id)), None)
-        if not client:
-            logger.error(f"Клиент с chat_id {chat_id} не найден среди существующих клиентов WireGuard")
+        if client_id is None:
             return False
+        if self._snapshot is not None:
+            self._snapshot.discard(client_id)
+        logger.info(f"Клиент {chat_id} успешно удалён из WireGuard (ID: {client_id})")
+        return True
 
-        client_id = client['id']
-        url = f"{self.base_url}/api/wireguard/client/{client_id}"
+# Один долгоживущий клиент (и пул соединений) на каждый сервер wg-easy
+_apis = {}
 
-        logger.info(f"Попытка удалить клиента с ID: {client_id} и chat_id: {chat_id}")
+def get_wg_api(base_url, password=None):
+    api = _apis.get(base_url)
+    if api is None:
+        api = WgEasyAPI(base_url=base_url, password=password or Config.WG_PASSWORD)
+        _apis[base_url] = api
+    return api
 
-        try:
-            response = requests.delete(url, headers=self.headers, cookies=self.session_cookies)
-            response.raise_for_status()
-            logger.info(f"Клиент {chat_id} успешно удалён из WireGuard (ID: {client_id})")
-            return True
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка при удалении клиента {chat_id} из WireGuard: {e}")
-            return False
+async def close_wg_apis():
+    for api in _apis.values():
+        await api.close()
+    _apis.clear()
+
+def snapshot_stats():
+    return {base_url: api.snapshot_stats() for base_url, api in _apis.items()}